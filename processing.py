@@ -15,6 +15,8 @@ import scripts.demand as demand
 import scripts.cop as cop
 import scripts.write as write
 import scripts.metadata as metadata
+import scripts.pipeline as pipeline
+import scripts.cache as cache
 
 # %%
 version = '2019-08-06'
@@ -39,6 +41,9 @@ regions = regions.loc[regions.country_code.isin(all_countries)]
 year_start = 2008
 year_end = 2009
 
+# %%
+workers = 1  # Number of processes across which years, regions, countries or population tiles are distributed
+
 # %%
 # ## Set ECMWF access key
 # In the following, this notebook downloads weather data from the ECMWF server. For accessing this server, follow the steps below:
@@ -88,10 +93,10 @@ download.population(input_path)
 # Population and weather data is preprocessed. This takes around 10 minutes to run.
 # %% [markdown]
 # ## Re-mapping population data
-# The population data from Eurostat features a 1 km² grid, which country-by-country transformed to the 0.75 x 0.75° grid of the weather data in the following. Interim results are saved/loaded from disk.
+# The population data from Eurostat features a 1 km² grid, which is transformed to the 0.75 x 0.75° grid of the weather data in the following. All regions are re-mapped in one pass, in which the population points are assigned to the regions by a single spatial join. Interim results are saved/loaded from disk.
 
 # %%
-mapped_population = preprocess.map_population(input_path, regions, interim_path)
+mapped_population = preprocess.map_population(input_path, regions, interim_path, workers=workers)
 
 
 # %%
@@ -109,9 +114,43 @@ mapped_population['AT']
 # %%
 wind = preprocess.wind(input_path, mapped_population)
 
+# %% [markdown]
+# ## Out-of-core mode
+# For long weather histories, heat demand and COP time series can alternatively be calculated year by year. Spatial interim results are then spilled to a chunked store on disk and aggregated from there by UTC year, so that memory requirements do not grow with the number of years. With more than one worker, the years are processed in parallel processes, each starting from a three-day lead-in for the reference temperature. In this case, the in-memory calculations of sections 4 and 5 are skipped, as well as the validation of the uncorrected COP, which needs the spatial COP time series, and the results are passed on to [writing](#write).
+
+# %%
+out_of_core = False
+
 
 # %%
-temperature = preprocess.temperature(input_path, year_start, year_end, mapped_population)
+if out_of_core:
+    final_heat, cop_ratio = pipeline.out_of_core(input_path, os.path.join(interim_path, 'store'),
+                                                 year_start, year_end, mapped_population, wind, regions, workers)
+    final_cop = cop.arrangement(cop_ratio)
+
+
+# %% [markdown]
+# ## Interim cache
+# Expensive interim results are cached in the interim directory. Each cached stage is keyed on a hash of all inputs and parameters it depends on, so that changed years, regions or parameter files never lead to stale results. The least recently used entries are evicted beyond the size limit of the cache.
+
+# %%
+cache_path = os.path.join(interim_path, 'cache')
+
+weather_key = cache.key(
+    cache.files(*[os.path.join(input_path, 'weather', 'ERA_temperature_{}.nc'.format(year))
+                  for year in range(year_start, year_end+1)]),
+    year_start, year_end, mapped_population
+)
+demand_key = cache.key(weather_key, wind, cache.files(os.path.join(input_path, 'bgw_bdew')))
+spatial_key = cache.key(demand_key, regions.id.tolist(), regions.country_code.tolist(),
+                        cache.files(os.path.join(input_path, 'eu_building_database')))
+cop_key = cache.key(weather_key, cache.files(os.path.join(input_path, 'cop')))
+
+
+# %%
+if not out_of_core:
+    temperature = cache.cached(cache_path, 'temperature', weather_key,
+                               preprocess.temperature, input_path, year_start, year_end, mapped_population)
 
 # %% [markdown]
 # <a id=demand></a>
@@ -120,10 +159,12 @@ temperature = preprocess.temperature(input_path, year_start, year_end, mapped_po
 # %% [markdown]
 # ## Reference temperature
 # 
-# To capture the thermal inertia of buildings, the daily reference temperature is calculated as the weighted mean of the ambient air temperature of the actual and the three preceding days. 
+# To capture the thermal inertia of buildings, the daily reference temperature is calculated as the weighted mean of the ambient air temperature of the actual and the three preceding days. The daily average air temperature is kept for re-use in other stages.
 
 # %%
-reference_temperature = demand.reference_temperature(temperature['air'])
+if not out_of_core:
+    daily_temperature = demand.daily_average(temperature['air'])
+    reference_temperature = demand.reference_temperature(daily_temperature, averaged=True)
 
 # %% [markdown]
 # ## Daily demand
@@ -135,15 +176,17 @@ daily_parameters = read.daily_parameters(input_path)
 
 
 # %%
-daily_heat = demand.daily_heat(reference_temperature, 
-                               wind, 
-                               daily_parameters)
+if not out_of_core:
+    daily_heat = demand.daily_heat(reference_temperature, 
+                                   wind, 
+                                   daily_parameters)
 
 
 # %%
-daily_water = demand.daily_water(reference_temperature,
-                                 wind,
-                                 daily_parameters)
+if not out_of_core:
+    daily_water = demand.daily_water(reference_temperature,
+                                     wind,
+                                     daily_parameters)
 
 # %% [markdown]
 # ## Hourly demand
@@ -154,20 +197,14 @@ daily_water = demand.daily_water(reference_temperature,
 hourly_parameters = read.hourly_parameters(input_path)
 
 
-# %%
-hourly_heat = demand.hourly_heat(daily_heat,
-                                 reference_temperature, 
-                                 hourly_parameters)
-
-
-# %%
-hourly_water = demand.hourly_water(daily_water,
-                                   reference_temperature, 
-                                   hourly_parameters)
-
+# %% [markdown]
+# Space heating demand is the part of the heat demand exceeding the water heating demand. Both are calculated in one pass, without keeping the heat demand.
 
 # %%
-hourly_space = (hourly_heat - hourly_water).clip(lower=0)
+if not out_of_core:
+    hourly_space, hourly_water = cache.cached(cache_path, 'hourly_space_water', demand_key,
+                                              demand.hourly_space_water, daily_heat, daily_water,
+                                              reference_temperature, hourly_parameters)
 
 # %% [markdown]
 # ## Weight and scale
@@ -178,32 +215,25 @@ building_database = read.building_database(input_path)
 
 
 # %%
-spatial_space = demand.finishing(hourly_space, mapped_population, building_database['space'])
+if not out_of_core:
+    spatial_space = cache.cached(cache_path, 'spatial_space', spatial_key,
+                                 demand.finishing, hourly_space, mapped_population, building_database['space'],
+                                 regions, workers=workers)
 
 
 # %%
-spatial_water = demand.finishing(hourly_water, mapped_population, building_database['water'])
-
-# %% [markdown]
-# ## Safepoint
-# 
-# The following cells can be used to save and reload the spatial hourly time series.
-
-# %%
-spatial_space.to_pickle(os.path.join(interim_path, 'spatial_space'))
-spatial_water.to_pickle(os.path.join(interim_path, 'spatial_water'))
-
-
-# %%
-spatial_space = pd.read_pickle(os.path.join(interim_path, 'spatial_space'))[countries]
-spatial_water = pd.read_pickle(os.path.join(interim_path, 'spatial_water'))[countries]
+if not out_of_core:
+    spatial_water = cache.cached(cache_path, 'spatial_water', spatial_key,
+                                 demand.finishing, hourly_water, mapped_population, building_database['water'],
+                                 regions, workers=workers)
 
 # %% [markdown]
 # ## Aggregate and combine
 # All heat demand time series are aggregated country-wise and combined into one data frame.
 
 # %%
-final_heat = demand.combine(spatial_space, spatial_water)
+if not out_of_core:
+    final_heat = demand.combine(spatial_space, spatial_water)
 
 # %% [markdown]
 # <a id=cop></a>
@@ -211,17 +241,19 @@ final_heat = demand.combine(spatial_space, spatial_water)
 # For all years and countries, the calculation of the coefficient of performance (COP) of heat pumps takes around 5 minutes to run.
 # %% [markdown]
 # ## Source temperature 
-# For air-sourced, ground-sources and groundwater-sourced heat pumps (ASHP, GSHP and WSHP), the relevant heat source temperatures are calculated.
+# For air-sourced, ground-sources and groundwater-sourced heat pumps (ASHP, GSHP and WSHP), the relevant heat source temperatures are defined as affine functions of the air and soil temperatures. These are only evaluated together with the COP, so that constant temperatures are never expanded to full time series.
 
 # %%
-source_temperature = cop.source_temperature(temperature)
+source_temperature = cop.source_temperature()
+source_temperature
 
 # %% [markdown]
 # ## Sink temperatures
-# Heat sink temperatures, i.e. the temperature level at which the heat pumps have to provide heat, are calculated for floor heating, radiator heating and warm water.
+# Heat sink temperatures, i.e. the temperature level at which the heat pumps have to provide heat, are defined likewise for floor heating, radiator heating and warm water.
 
 # %%
-sink_temperature = cop.sink_temperature(temperature)
+sink_temperature = cop.sink_temperature()
+sink_temperature
 
 # %% [markdown]
 # ## COP
@@ -232,26 +264,17 @@ cop_parameters = read.cop_parameters(input_path)
 
 
 # %%
-spatial_cop = cop.spatial_cop(source_temperature, sink_temperature, cop_parameters)
-
-# %% [markdown]
-# ## Safepoint
-# 
-# The following cells can be used to save and reload the spatial hourly time series.
-
-# %%
-spatial_cop.to_pickle(os.path.join(interim_path, 'spatial_cop'))
-
-
-# %%
-spatial_cop = pd.read_pickle(os.path.join(interim_path, 'spatial_cop'))[countries]
+if not out_of_core:
+    spatial_cop = cache.cached(cache_path, 'spatial_cop', cop_key,
+                               cop.spatial_cop, temperature, source_temperature, sink_temperature, cop_parameters)
 
 # %% [markdown]
 # ## Aggregating and correction
 # The spatial COP time series are weighted with the spatial heat demand and aggregated into national time series. The national time series are corrected for part-load losses.
 
 # %%
-final_cop = cop.finishing(spatial_cop, spatial_space, spatial_water)
+if not out_of_core:
+    final_cop = cop.finishing(spatial_cop, spatial_space, spatial_water, workers=workers)
 
 # %% [markdown]
 # ## COP averages
@@ -262,8 +285,9 @@ cop.validation(final_cop, final_heat, interim_path, 'corrected')
 
 
 # %%
-cop.validation(cop.finishing(spatial_cop, spatial_space, spatial_water, correction=1),
-               final_heat, interim_path, "uncorrected")
+if not out_of_core:
+    cop.validation(cop.finishing(spatial_cop, spatial_space, spatial_water, correction=1, workers=workers),
+                   final_heat, interim_path, "uncorrected")
 
 # %% [markdown]
 # <a id=write></a>
@@ -278,9 +302,9 @@ cop.validation(cop.finishing(spatial_cop, spatial_space, spatial_water, correcti
 # * MultiIndex (easy to read into GAMS, not compatible with datapackage standard, small file size)
 #   * Fileformat: CSV, Excel
 # * Stacked (compatible with data package standard, large file size, many rows, too many for Excel)
-#   * Fileformat: CSV
+#   * Fileformat: CSV, Parquet
 # %% [markdown]
-# The different shapes are created before they are saved to files.
+# The data are merged and the timestamps are formatted once before the different shapes are saved to files.
 
 # %%
 shaped_dfs = write.shaping(final_heat, final_cop)
@@ -295,10 +319,16 @@ write.to_sql(shaped_dfs, output_path, home_path)
 # and to CSV.
 
 # %%
-write.to_csv(shaped_dfs, output_path)
+write.to_csv(shaped_dfs, output_path, workers=workers)
 
 # %% [markdown]
 # Writing to Excel takes extremely long. As a workaround, a copy of the multi-indexed data is writtten to CSV and manually converted to Excel.
+# %% [markdown]
+# The stacked shape is also written to Parquet, partitioned by country and variable, from where single countries and variables can be read without parsing the full data.
+
+# %%
+write.to_parquet(shaped_dfs, output_path)
+
 # %% [markdown]
 # ## Metadata
 # The metadata is reported in a JSON file.
@@ -312,6 +342,12 @@ metadata.make_json(shaped_dfs, version, changes, year_start, year_end, output_pa
 # %%
 shutil.copytree(input_path, os.path.join(output_path, 'original_data'))
 
+# %% [markdown]
+# ## Cache statistics
+
+# %%
+cache.report()
+
 # %% [markdown]
 # ## Checksums
 
@@ -0,0 +1,196 @@
+import os
+import shutil
+import pickle
+import hashlib
+import numpy as np
+import pandas as pd
+
+
+# Default size limit of the cache directory in bytes, beyond which the least recently used entries are evicted
+size_limit = 50 * 1024 ** 3
+
+# Hits and misses of the current session
+stats = {'hits': 0, 'misses': 0}
+
+# Sizes of the entries by cache directory, which is walked once per session and kept up to date on writes and evictions
+entry_sizes = {}
+
+
+def cached(cache_path, stage, key, func, *args, **kwargs):
+
+    # The result of func(*args, **kwargs) is read from the cache if an entry with the same stage and key exists
+    # Otherwise, it is calculated and written to the cache
+    path = os.path.join(cache_path, '{}-{}'.format(stage, key))
+
+    if os.path.isfile(os.path.join(path, 'structure.pkl')):
+        stats['hits'] += 1
+        print('{} is read from the cache ({}).'.format(stage, key[:12]))
+        os.utime(path)  # Mark as recently used
+        return load(path)
+
+    stats['misses'] += 1
+    print('{} is not in the cache ({}) and calculated.'.format(stage, key[:12]))
+    result = func(*args, **kwargs)
+
+    # Entries are written to a temporary directory first, so that incomplete entries are never read
+    os.makedirs(cache_path, exist_ok=True)
+    temporary_path = path + '.tmp'
+    shutil.rmtree(temporary_path, ignore_errors=True)
+    save(result, temporary_path)
+    shutil.rmtree(path, ignore_errors=True)  # Entries of an earlier format
+    os.rename(temporary_path, path)
+
+    sizes(cache_path)[path] = size(path)
+    evict(cache_path)
+
+    return result
+
+
+def key(*parts):
+
+    # Hash of all parts, which may be nested lists, tuples and dicts of scalars, strings, arrays and pandas objects
+    # Files are included by their fingerprint (see files)
+    sha = hashlib.sha256()
+
+    def update(part):
+        if isinstance(part, (pd.DataFrame, pd.Series, pd.Index)):
+            sha.update(repr(type(part)).encode())
+            sha.update(pd.util.hash_pandas_object(part, index=True).values.tobytes())
+            if isinstance(part, pd.DataFrame):
+                update(list(part.columns))
+        elif isinstance(part, np.ndarray):
+            sha.update(part.dtype.str.encode() + str(part.shape).encode() + np.ascontiguousarray(part).tobytes())
+        elif isinstance(part, dict):
+            for item_key, item in part.items():
+                update(item_key)
+                update(item)
+        elif isinstance(part, (list, tuple)):
+            sha.update(b'(')
+            for item in part:
+                update(item)
+            sha.update(b')')
+        else:
+            sha.update(repr(part).encode() + b';')
+
+    for part in parts:
+        update(part)
+
+    return sha.hexdigest()
+
+
+def files(*paths):
+
+    # Fingerprint of files and (recursively) directories by path, size and modification time
+    fingerprints = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in sorted(os.walk(path)):
+                fingerprints += files(*[os.path.join(root, name) for name in sorted(names)])
+        elif os.path.isfile(path):
+            stat = os.stat(path)
+            fingerprints.append((os.path.abspath(path), stat.st_size, stat.st_mtime_ns))
+        else:
+            fingerprints.append((os.path.abspath(path), None, None))
+
+    return fingerprints
+
+
+def save(obj, path):
+
+    os.makedirs(path)
+
+    # DataFrames and Series are saved as binary arrays of values with pickled labels, also within tuples, lists
+    # and dicts, of which only the structure and any other contents are pickled
+    def pack(obj):
+        if isinstance(obj, (tuple, list)):
+            return type(obj).__name__, [pack(item) for item in obj]
+
+        if isinstance(obj, dict):
+            return 'dict', [(item_key, pack(item)) for item_key, item in obj.items()]
+
+        if isinstance(obj, (pd.DataFrame, pd.Series)) and binary(obj):
+            file = 'values_{}.npy'.format(len(os.listdir(path)))
+            np.save(os.path.join(path, file), obj.values)
+            return type(obj).__name__, {
+                'file': file,
+                'index': obj.index,
+                'columns': obj.columns if isinstance(obj, pd.DataFrame) else None,
+                'name': obj.name if isinstance(obj, pd.Series) else None
+            }
+
+        return 'object', obj
+
+    structure = pack(obj)
+    with open(os.path.join(path, 'structure.pkl'), 'wb') as f:
+        pickle.dump(structure, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def binary(obj):
+
+    # Frames of a single numpy dtype other than object can be saved as a binary array
+    dtypes = set(np.atleast_1d(obj.dtypes))
+    return len(dtypes) == 1 and all(isinstance(dtype, np.dtype) and dtype.kind != 'O' for dtype in dtypes)
+
+
+def load(path):
+
+    with open(os.path.join(path, 'structure.pkl'), 'rb') as f:
+        structure = pickle.load(f)
+
+    def unpack(kind, content):
+        if kind in ['tuple', 'list']:
+            return (tuple if kind == 'tuple' else list)(unpack(*item) for item in content)
+
+        if kind == 'dict':
+            return {item_key: unpack(*item) for item_key, item in content}
+
+        if kind == 'Series':
+            values = np.load(os.path.join(path, content['file']))
+            return pd.Series(values, index=content['index'], name=content['name'])
+
+        if kind == 'DataFrame':
+            values = np.load(os.path.join(path, content['file']))
+            return pd.DataFrame(values, index=content['index'], columns=content['columns'])
+
+        return content
+
+    return unpack(*structure)
+
+
+def sizes(cache_path):
+
+    if cache_path not in entry_sizes:
+        entry_sizes[cache_path] = {
+            os.path.join(cache_path, entry): size(os.path.join(cache_path, entry))
+            for entry in os.listdir(cache_path) if not entry.endswith('.tmp')
+        }
+
+    return entry_sizes[cache_path]
+
+
+def size(path):
+
+    return sum(file_size for _, file_size, _ in files(path) if file_size is not None)
+
+
+def evict(cache_path, limit=None):
+
+    limit = size_limit if limit is None else limit
+    entries = sizes(cache_path)
+
+    total = sum(entries.values())
+    if total <= limit:
+        return
+
+    # Entries are evicted from the least to the most recently used, keeping at least the most recent one
+    for entry in sorted([entry for entry in entries if os.path.isdir(entry)], key=os.path.getmtime)[:-1]:
+        if total <= limit:
+            break
+        print('{} is evicted from the cache.'.format(os.path.basename(entry)))
+        shutil.rmtree(entry)
+        total -= entries.pop(entry)
+
+
+def report():
+
+    print('Cache hits: {hits}, misses: {misses}'.format(**stats))
@@ -1,103 +1,174 @@
 
 import os
+import numpy as np
 import pandas as pd
 
+import scripts.parallel as parallel
 from scripts.misc import localize
 from scripts.misc import group_df_by_multiple_column_levels
+from scripts.demand import spatial_unit
 
 
-def source_temperature(temperature):
+def source_temperature():
+
+    # Source temperatures in °C as affine functions of the air and soil temperatures in °C
+    # These are evaluated with the shared temperature data in the calculation of the COP (see cop_array)
+    return pd.DataFrame(
+        [[1, 0, 0],
+         [0, 1, -5],
+         [0, 0, 10 - 5]],
+        index=pd.Index(['air', 'ground', 'water'], name='source'),
+        columns=['air', 'soil', 'constant']
+    )
 
-    celsius = temperature - 273.15
 
-    return pd.concat(
-        [celsius['air'], celsius['soil'] - 5, 0 * celsius['air'] + 10 - 5],
-        keys=['air', 'ground', 'water'],
-        names=['source', 'country', 'latitude', 'longitude'],
-        axis=1
+def sink_temperature():
+
+    # Sink temperatures in °C as affine functions of the air and soil temperatures in °C
+    return pd.DataFrame(
+        [[-1, 0, 40],
+         [-.5, 0, 30],
+         [0, 0, 50]],
+        index=pd.Index(['radiator', 'floor', 'water'], name='sink'),
+        columns=['air', 'soil', 'constant']
     )
 
 
-def sink_temperature(temperature):
+def spatial_cop(temperature, source, sink, cop_parameters):
 
-    celsius = temperature['air'] - 273.15
+    values, cells = cop_array(temperature, source, sink, cop_parameters)
 
-    return pd.concat(
-        [-1 * celsius + 40, -.5 * celsius + 30, 0 * celsius + 50],
-        keys=['radiator', 'floor', 'water'],
-        names=['sink', 'country', 'latitude', 'longitude'],
-        axis=1
+    # The array is viewed as a DataFrame with columns ordered by source, sink and cell
+    columns = pd.MultiIndex.from_arrays(
+        [np.tile(cells.get_level_values('country'), len(source) * len(sink)),
+         np.tile(np.repeat(sink.index, len(cells)), len(source)),
+         np.repeat(source.index, len(sink) * len(cells)),
+         np.tile(cells.get_level_values('latitude'), len(source) * len(sink)),
+         np.tile(cells.get_level_values('longitude'), len(source) * len(sink))],
+        names=['country', 'sink', 'source', 'latitude', 'longitude']
     )
 
+    return pd.DataFrame(values.reshape(len(temperature.index), -1), index=temperature.index, columns=columns)
+
+
+def cop_array(temperature, source, sink, cop_parameters):
+
+    # COP of all combinations of source and sink types as array of shape (time, source, sink, cell)
+    cells = temperature['air'].columns
+    celsius = {parameter: temperature[parameter].reindex(columns=cells).values - 273.15
+               for parameter in ['air', 'soil']}
+
+    # Coefficients of the quadratic COP curves as array of shape (coefficient, source),
+    # in the dtype of the temperatures so that the COP is not upcast
+    dtype = celsius['air'].dtype
+    coefficients = cop_parameters.loc[range(3), source.index].values.astype(dtype)
+
+    values = np.empty((len(temperature.index), len(source), len(sink), len(cells)), dtype=dtype)
+
+    for i, source_type in enumerate(source.index):
+        for j, sink_type in enumerate(sink.index):
+
+            # The temperature difference is only evaluated for the temperatures it depends on,
+            # so that the COP curve of a constant difference is evaluated once and broadcast to its slice
+            terms = sink.loc[sink_type] - source.loc[source_type]
+            delta_t = values.dtype.type(terms['constant'])
+            for parameter in celsius.keys():
+                if terms[parameter] != 0:
+                    delta_t = float(terms[parameter]) * celsius[parameter] + delta_t
+
+            values[:, i, j] = cop_curve(delta_t, coefficients[:, i])
+
+    return values.round(4, out=values), cells
+
+
+def cop_curve(delta_t, coefficients):
+
+    # Quadratic COP curve in Horner form, with temperature differences limited to 15 K
+    delta_t = np.maximum(delta_t, 15)
 
-def spatial_cop(source, sink, cop_parameters):
+    return (coefficients[2] * delta_t + coefficients[1]) * delta_t + coefficients[0]
 
-    def cop_curve(delta_t, source_type):
-        delta_t.clip(lower=15, inplace=True)
-        return sum(cop_parameters.loc[i, source_type] * delta_t ** i for i in range(3))
 
-    source_types = source.columns.get_level_values('source').unique()
-    sink_types = sink.columns.get_level_values('sink').unique()
+def finishing(cop, demand_space, demand_water, correction=.85, workers=1):
 
-    return pd.concat(
-        [pd.concat(
-            [cop_curve(sink[sink_type] - source[source_type], source_type)
-             for sink_type in sink_types],
-            keys=sink_types,
-            axis=1
-        ) for source_type in source_types],
-        keys=source_types,
-        axis=1,
-        names=['source', 'sink', 'country', 'latitude', 'longitude']
-    ).round(4).swaplevel(0, 2, axis=1)
+    return arrangement(aggregation(cop, demand_space, demand_water, workers), correction)
 
 
-def finishing(cop, demand_space, demand_water, correction=.85):
+def aggregation(cop, demand_space, demand_water, workers=1):
 
-    # Localize Timestamps (including daylight saving time correction) and convert to UTC
+    # Prepare demand values
+    demand_space = group_df_by_multiple_column_levels(spatial_unit(demand_space, 'MW/TWh'),
+                                                      ['country', 'latitude', 'longitude'])
+    demand_water = group_df_by_multiple_column_levels(spatial_unit(demand_water, 'MW/TWh'),
+                                                      ['country', 'latitude', 'longitude'])
+
+    # Countries are processed in parallel with more than one worker, sharing the spatial data in memory
     countries = cop.columns.get_level_values('country').unique()
-    sinks = cop.columns.get_level_values('sink').unique()
-    cop = pd.concat(
-        [pd.concat(
-            [pd.concat(
-                [localize(cop[country][sink], country).tz_convert('utc') for sink in sinks],
-                keys=sinks, axis=1
-            )], keys=[country], axis=1
-        ).swaplevel(0, 2, axis=1) for country in countries],
-        axis=1, names=['source', 'sink', 'country', 'latitude', 'longitude']
+    results = parallel.starmap(
+        country_aggregation, {'cop': cop, 'demand_space': demand_space, 'demand_water': demand_water},
+        [{'country': country} for country in countries], workers
     )
 
-    # Prepare demand values
-    demand_space = demand_space.loc[:, demand_space.columns.get_level_values('unit') == 'MW/TWh']
-    demand_space = group_df_by_multiple_column_levels(demand_space, ['country', 'latitude', 'longitude'])
+    power = pd.concat([power for power, _ in results], keys=countries, axis=1)
+    heat = pd.concat([heat for _, heat in results], keys=countries, axis=1)
 
-    demand_water = demand_water.loc[:, demand_water.columns.get_level_values('unit') == 'MW/TWh']
-    demand_water = group_df_by_multiple_column_levels(demand_water, ['country', 'latitude', 'longitude'])
+    # Demand-weighted COP
+    cop = heat / power
+    cop.columns = cop.columns.reorder_levels([1, 2, 0])
+    cop.columns.names = ['source', 'sink', 'country']
 
-    # Spatial aggregation
-    sources = cop.columns.get_level_values('source').unique()
+    return cop.sort_index(axis=1)
+
+
+def country_aggregation(cop, demand_space, demand_water, country):
+
+    # Localize Timestamps (including daylight saving time correction) of all sinks and sources at once
+    # and convert to UTC
+    cop = localize(cop[country], country).tz_convert('utc')
     sinks = cop.columns.get_level_values('sink').unique()
-    power = pd.concat(
-        [pd.concat(
-            [(demand_water / cop[source][sink]).sum(level=0, axis=1)
-             if sink == 'water' else
-             (demand_space / cop[source][sink]).sum(level=0, axis=1)
-             for sink in sinks],
-            keys=sinks, axis=1
-        ) for source in sources],
-        keys=sources, axis=1, names=['source', 'sink', 'country']
-    )
+    sources = cop.columns.get_level_values('source').unique()
+    cells = cop.columns.droplevel(['sink', 'source']).unique()
+
+    # The demand of each sink class at the COP time steps and cells weights the inverse COP
+    # Missing demand values do not count, as in a sum skipping them
+    demand = {'space': demand_space[country], 'water': demand_water[country]}
+    weights = {
+        heat_type: np.nan_to_num(df.reindex(index=cop.index, columns=cells).values.astype('float64'))
+        for heat_type, df in demand.items()
+    }
+    index = cop.index.union(demand_space.index)
+    rows = index.get_indexer(cop.index)
+
+    # Demand-weighted sums of the inverse COP, computed as row-wise dot products of the weights and the inverse COP
+    # in a buffer, so that no quotients of demand and COP are materialized
+    values = cop.values
+    inverse = np.empty((len(cop.index), len(cells)))
+    columns = pd.MultiIndex.from_product([sources, sinks])
+    power = np.zeros((len(index), len(columns)),
+                     dtype=np.result_type(demand_space.values.dtype, demand_water.values.dtype, values.dtype))
+    for column, (source, sink) in enumerate(columns):
+        positions = cop.columns.get_indexer(pd.MultiIndex.from_tuples([(sink, source) + cell for cell in cells]))
+        np.divide(1., values[:, positions], out=inverse)
+        power[rows, column] = np.einsum('ij,ij->i', weights['water' if sink == 'water' else 'space'], inverse)
+    power = pd.DataFrame(power, index=index, columns=columns)
+
+    # The heat, i.e. the demand sum, is computed once per sink class
+    # The sums are taken in float64 over a C-ordered copy, so that they do not depend on the memory layout,
+    # and are returned in the dtype of the demand
+    heat_sums = {
+        heat_type: pd.Series(np.nan_to_num(np.array(df.values, dtype='float64', order='C')).sum(axis=1)
+                             .astype(df.values.dtype), index=df.index)
+        for heat_type, df in demand.items()
+    }
     heat = pd.concat(
-        [pd.concat(
-            [demand_water.sum(level=0, axis=1)
-             if sink == 'water' else
-             demand_space.sum(level=0, axis=1)
-             for sink in sinks],
-            keys=sinks, axis=1
-        ) for source in sources],
-        keys=sources, axis=1, names=['source', 'sink', 'country']
+        [heat_sums['water' if sink == 'water' else 'space'] for _, sink in power.columns],
+        keys=power.columns, axis=1
     )
-    cop = heat / power
+
+    return power, heat
+
+
+def arrangement(cop, correction=.85):
 
     # Correction and round
     cop = (cop * correction).round(2)
@@ -106,8 +177,7 @@ def finishing(cop, demand_space, demand_water, correction=.85):
     cop = cop.fillna(method='bfill').fillna(method='ffill')
 
     # Rename columns
-    cop.columns.set_levels(['ASHP', 'GSHP', 'WSHP'], level=0, inplace=True)
-    cop.columns.set_levels(['radiator', 'floor', 'water'], level=1, inplace=True)
+    cop = cop.rename(columns={'air': 'ASHP', 'ground': 'GSHP', 'water': 'WSHP'}, level=0)
     cop.columns = pd.MultiIndex.from_tuples([('_'.join([level for level in col_name[0:2]]), col_name[2]) for col_name in cop.columns.values])
     cop = pd.concat([cop], keys=['COP'], axis=1)
     cop = pd.concat([cop], keys=['coefficient'], axis=1)
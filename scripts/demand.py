@@ -2,37 +2,64 @@
 import numpy as np
 import pandas as pd
 
-from scripts.misc import localize, upsample_df, group_df_by_multiple_column_levels
+import scripts.parallel as parallel
+from scripts.misc import localize, timezone, upsample_index, group_df_by_multiple_column_levels, fill_gaps
 
 
-def reference_temperature(temperature):
+# Temperature classes of the hourly factors from BGW 2006
+temperature_classes = np.arange(-15, 35, 5)
 
-    # Daily average
-    daily_average = temperature.groupby(pd.Grouper(freq='D')).mean().copy()
+# Building types of the standard load profiles
+buildings = ['SFH', 'MFH', 'COM']
+
+
+def reference_temperature(temperature, state=None, averaged=False):
+
+    # Daily average, unless the input is already averaged
+    daily_temperature = temperature if averaged else daily_average(temperature)
 
     # Weighted mean
-    return sum([.5 ** i * daily_average.shift(i).fillna(method='bfill') for i in range(4)]) / \
-           sum([.5 ** i for i in range(4)])
+    values, _ = reference_filter(daily_temperature.values, state)
 
+    return pd.DataFrame(values, index=daily_temperature.index, columns=daily_temperature.columns)
 
-def daily_heat(temperature, wind, all_parameters):
 
-    # BDEW et al. 2015 describes the function for the daily heat demand
-    # This is implemented in the following and passed to the general daily function
+def daily_average(temperature):
+
+    index = temperature.index
+
+    # Complete days of hourly values are averaged on the reshaped array instead of a groupby
+    if len(index) % 24 == 0 and (index[0] == index[0].normalize()) and \
+            (np.diff(index.values) == np.timedelta64(1, 'h')).all():
+        values = temperature.values.reshape(-1, 24, temperature.shape[1]).mean(axis=1, dtype='float64')
+        return pd.DataFrame(values.astype(temperature.values.dtype), columns=temperature.columns,
+                            index=pd.date_range(index[0], periods=len(values), freq='D'))
+
+    return temperature.groupby(pd.Grouper(freq='D')).mean()
 
-    def heat_function(t, parameters):
 
-        celsius = t - 273.15  # The temperature input is in Kelvin
+def reference_filter(daily_temperature, state=None):
 
-        sigmoid = parameters['A'] / (
-                1 + (parameters['B'] / (celsius - 40)) ** parameters['C']
-        ) + parameters['D']
+    # The state holds the daily averages of the three days preceding the first day, oldest first
+    # Without a state, the first day is repeated, i.e. the preceding days are assumed to be alike
+    if state is None:
+        state = np.repeat(daily_temperature[:1], 3, axis=0)
 
-        linear = pd.DataFrame(
-            [parameters['m_{}'.format(i)] * celsius + parameters['b_{}'.format(i)] for i in ['s', 'w']]
-        ).max()
+    padded = np.concatenate([state, daily_temperature])
+    length = len(daily_temperature)
 
-        return sigmoid + linear
+    # Weighted mean of the actual and the three preceding days
+    values = sum([.5 ** i * padded[3 - i:3 - i + length] for i in range(4)]) / \
+             sum([.5 ** i for i in range(4)])
+
+    # The last three days are carried over to the next chunk
+    return values, padded[-3:].copy()
+
+
+def daily_heat(temperature, wind, all_parameters):
+
+    # BDEW et al. 2015 describes the function for the daily heat demand
+    # This is implemented in heat_function and passed to the general daily function
 
     return daily(temperature, wind, all_parameters, heat_function)
 
@@ -40,96 +67,227 @@ def daily_heat(temperature, wind, all_parameters):
 def daily_water(temperature, wind, all_parameters):
 
     # A function for the daily water heating demand is derived from BDEW et al. 2015
-    # This is implemented in the following and passed to the general daily function
+    # This is implemented in water_function and passed to the general daily function
+
+    return daily(temperature, wind, all_parameters, water_function)
 
-    def water_function(t, parameters):
 
-        celsius = t - 273.15  # The temperature input is in Kelvin
+def heat_function(t, parameters):
 
-        # Below 15 °C, the water heating demand is not defined and assumed to stay constant
-        celsius.clip(15, inplace=True)
+    celsius = t - 273.15  # The temperature input is in Kelvin
 
-        return parameters['m_w'] * celsius + parameters['b_w'] + parameters['D']
+    sigmoid = parameters['A'] / (
+            1 + (parameters['B'] / (celsius - 40)) ** parameters['C']
+    ) + parameters['D']
 
-    return daily(temperature, wind, all_parameters, water_function)
+    linear = np.maximum(
+        *[parameters['m_{}'.format(i)] * celsius + parameters['b_{}'.format(i)] for i in ['s', 'w']]
+    )
+
+    return sigmoid + linear
+
+
+def water_function(t, parameters):
+
+    celsius = t - 273.15  # The temperature input is in Kelvin
+
+    # Below 15 °C, the water heating demand is not defined and assumed to stay constant
+    celsius = np.maximum(celsius, 15)
+
+    return parameters['m_w'] * celsius + parameters['b_w'] + parameters['D']
 
 
 def daily(temperature, wind, all_parameters, func):
 
     # All locations are separated by the average wind speed with the threshold 4.4 m/s
-    windy_locations = {
-        'normal': wind[wind <= 4.4].index,
-        'windy': wind[wind > 4.4].index
-    }
+    windy = wind.reindex(temperature.columns).values > 4.4
+
+    values = daily_array(temperature.values, windy, all_parameters, func)
+
+    # The (building, time, location) array is flattened to building-wise columns
+    return pd.DataFrame(
+        values.transpose(1, 0, 2).reshape(len(temperature.index), -1),
+        index=temperature.index,
+        columns=pd.MultiIndex.from_tuples(
+            [(building,) + location for building in buildings for location in temperature.columns],
+            names=['building', 'country', 'latitude', 'longitude']
+        )
+    )
 
-    buildings = ['SFH', 'MFH', 'COM']
 
-    return pd.concat(
-        [pd.concat(
-            [temperature[locations].apply(func, parameters=all_parameters[(building, windiness)])
-             for windiness, locations in windy_locations.items()],
-            axis=1
-        ) for building in buildings],
-        keys=buildings, names=['building', 'country', 'latitude', 'longitude'], axis=1
-    )
+def daily_array(temperature, windy, all_parameters, func):
+
+    # The function is evaluated for all buildings, time steps and locations at once
+    return func(
+        temperature.astype('float32')[np.newaxis],
+        location_parameters(windy, all_parameters)
+    ).astype('float32')
+
+
+def location_parameters(windy, all_parameters):
+
+    # Parameter arrays of shape (building, 1, location), chosen by the windiness of each location
+    return {
+        parameter: np.stack(
+            [np.where(windy,
+                      all_parameters.loc[parameter, (building, 'windy')],
+                      all_parameters.loc[parameter, (building, 'normal')])
+             for building in buildings]
+        )[:, np.newaxis, :].astype('float32')
+        for parameter in all_parameters.index
+    }
 
 
 def hourly_heat(daily_df, temperature, parameters):
 
     # According to BGW 2006, temperature classes are derived from the temperature data
-    # This is re-sampled to a 60-min-resolution and passed to the general hourly function
-
-    classes = upsample_df(
-        (np.ceil(((temperature - 273.15) / 5).astype('float64')) * 5).clip(lower=-15, upper=30),
-        '60min'
-    ).astype(int).astype(str)
+    # These are passed as int8 class codes in the daily resolution to the general hourly function
 
-    return hourly(daily_df, classes, parameters)
+    return hourly(daily_df, temperature_class_codes(temperature), parameters)
 
 
 def hourly_water(daily_df, temperature, parameters):
 
     # For water heating, the highest temperature classes '30' is chosen
-    # This is re-sampled to a 60-min-resolution and passed to the general hourly function
+    # This is passed as a single scalar class code to the general hourly function
 
-    classes = upsample_df(
-        pd.DataFrame(30, index=temperature.index, columns=temperature.columns),
-        '60min'
-    ).astype(int).astype(str)
+    return hourly(daily_df, temperature_classes.searchsorted(30), parameters)
 
-    return hourly(daily_df, classes, parameters)
+
+def temperature_class_codes(temperature):
+
+    # Temperature classes in steps of 5 °C from -15 to 30 °C, encoded by their position in temperature_classes
+    classes = np.ceil(((temperature - 273.15) / 5).astype('float64')).clip(lower=-3, upper=6)
+
+    return (classes + 3).astype('int8')
 
 
 def hourly(daily_df, classes, parameters):
 
-    def hourly_factors(building):
+    buildings, results = zip(*hourly_blocks(daily_df, classes, parameters))
+
+    results = pd.concat(
+        results,
+        keys=buildings, names=['building', 'country', 'latitude', 'longitude'], axis=1
+    )
+
+    return results.swaplevel('building', 'country', axis=1)
+
+
+def hourly_blocks(daily_df, classes, parameters, block_size=None):
+
+    # Hourly demand of one building type after the other as (building, DataFrame),
+    # optionally in blocks of at most block_size locations
+
+    tables = hourly_factor_tables(parameters)
+
+    # The daily values are used at hourly positions without upsampling the DataFrame
+    index, days = upsample_index(daily_df.index, '60min')
+
+    # Hour and weekday codes are computed once for the whole time axis
+    hours, weekdays = time_codes(index)
+
+    # Class codes are either given per location in the daily resolution or as a scalar for all locations
+    if np.ndim(classes):
+        class_days = classes.index.searchsorted(index, side='right') - 1
+
+    def hourly_demand(df, building):
 
         # This function selects hourly factors from BGW 2006 by time and temperature class
-        slp = pd.DataFrame(index=classes.index, columns=classes.columns)
+        codes = classes.reindex(columns=df.columns).values[class_days] if np.ndim(classes) else classes
+        values = df.values[days]
+        values *= hourly_factor_lookup(tables[building], hours, weekdays, codes)
 
-        # Time includes the hour of the day
-        times = classes.index.map(lambda x: x.strftime('%H:%M'))
-        # For commercial buildings, time additionally includes the weekday
-        if building == 'COM':
-            weekdays = classes.index.map(lambda x: int(x.strftime('%w')))
-            times = list(zip(weekdays, times))
+        return pd.DataFrame(values, index=index, columns=df.columns)
 
-        for column in classes.columns:
-            slp[column] = parameters[building].lookup(times, classes.loc[:, column])
+    for building in daily_df.columns.get_level_values('building').unique():
+        df = daily_df[building]
+        size = block_size or max(df.shape[1], 1)
+        for start in range(0, df.shape[1], size):
+            yield building, hourly_demand(df.iloc[:, start:start + size], building)
 
-        return slp
 
-    buildings = daily_df.columns.get_level_values('building').unique()
+def hourly_space_water(daily_heat, daily_water, temperature, parameters, keep_heat=False, block_size=256):
 
-    results = pd.concat(
-        [upsample_df(daily_df, '60min')[building] * hourly_factors(building) for building in buildings],
-        keys=buildings, names=['building', 'country', 'latitude', 'longitude'], axis=1
+    # Space and water heating demand are calculated in one pass over blocks of locations, space heating being
+    # the part of the heat demand that exceeds water heating
+    # Besides space and water heating, only the heat demand of one block is held at a time,
+    # unless the heat demand of all locations is to be kept
+    buildings = daily_heat.columns.get_level_values('building').unique()
+    columns = pd.MultiIndex.from_tuples(
+        [(location[0], building) + location[1:] for building in buildings for location in daily_heat[building].columns],
+        names=['country', 'building', 'latitude', 'longitude']
     )
+    names = ['space', 'water', 'heat'] if keep_heat else ['space', 'water']
 
-    return results.swaplevel('building', 'country', axis=1)
+    results = {}
+    start = 0
+    for (_, heat), (_, water) in zip(
+            hourly_blocks(daily_heat, temperature_class_codes(temperature), parameters, block_size),
+            hourly_blocks(daily_water[buildings], temperature_classes.searchsorted(30), parameters, block_size)):
+
+        if not results:
+            results = {name: np.empty((len(heat.index), len(columns)), dtype=heat.values.dtype) for name in names}
+        block = slice(start, start + heat.shape[1])
+        start = block.stop
+
+        if not water.columns.equals(heat.columns):
+            water = water.reindex(columns=heat.columns)
+        results['water'][:, block] = water.values
+        if keep_heat:
+            results['heat'][:, block] = heat.values
+        np.subtract(heat.values, results['water'][:, block], out=results['space'][:, block])
+        np.maximum(results['space'][:, block], 0, out=results['space'][:, block])
+
+    return tuple(pd.DataFrame(results[name], index=heat.index, columns=columns) for name in names)
+
+
+def hourly_factor_tables(parameters):
 
+    # The hourly factors from BGW 2006 are transformed into dense arrays of shape
+    # (hour, class) for residential and (weekday, hour, class) for commercial buildings
+    tables = {}
+    for building, df in parameters.items():
 
-def finishing(df, mapped_population, building_database, regions):
+        values = df[temperature_classes.astype(str)].values
+        hours = np.array([int(time.split(':')[0]) for time in df.index.get_level_values(-1)])
+
+        if df.index.nlevels == 2:
+            weekdays = df.index.get_level_values(0).astype(int)
+            table = np.full((7, 24, len(temperature_classes)), np.nan, dtype=values.dtype)
+            table[weekdays, hours] = values
+        else:
+            table = np.full((24, len(temperature_classes)), np.nan, dtype=values.dtype)
+            table[hours] = values
+
+        tables[building] = table
+
+    return tables
+
+
+def time_codes(index):
+
+    # Integer hour of the day and weekday, the latter counted from Sunday (0) as in BGW 2006
+    hours = np.asarray(index.hour, dtype='int8')
+    weekdays = ((np.asarray(index.dayofweek) + 1) % 7).astype('int8')
+
+    return hours, weekdays
+
+
+def hourly_factor_lookup(table, hours, weekdays, codes):
+
+    # The table row of each time step, including the weekday for commercial buildings
+    if table.ndim == 3:
+        rows = weekdays.astype(int) * 24 + hours
+        table = table.reshape(-1, table.shape[-1])
+    else:
+        rows = hours.astype(int)
+
+    # Single gather for all time steps and locations; codes are either of shape (time, location) or scalar
+    return table[rows[:, np.newaxis], codes]
+
+
+def finishing(df, mapped_population, building_database, regions, sums=None, workers=1):
 
     # Single- and multi-family houses are aggregated assuming a ratio of 70:30
     # Transforming to heat demand assuming an average conversion efficiency of 0.9
@@ -139,89 +297,190 @@ def finishing(df, mapped_population, building_database, regions):
         'COM': .9 * building_database['commercial']
     }
 
-    results = []
-    for country, population in mapped_population.items():
+    # Regions are processed in parallel with more than one worker, sharing df in memory
+    macro_countries = {country: regions.loc[regions.id == country]['country_code'].values[0]
+                       for country in mapped_population.keys()}
+    results = parallel.starmap(
+        region_finishing, {'df': df},
+        [{'country': country,
+          'population': population,
+          'macro_country': macro_countries[country]}
+         for country, population in mapped_population.items()],
+        workers, building_database=building_database, sums=sums
+    )
 
-        macro_country = regions.loc[regions.id == country]['country_code'].values[0]
+    # The spatial time series in both units differ only by factors per region, building type and year,
+    # so only the weighted time series and the factors are kept (see spatial_unit)
+    return {
+        'weighted': pd.concat([weighted for weighted, _, _ in results], keys=mapped_population.keys(), axis=1,
+                              names=['country', 'building_type', 'latitude', 'longitude']),
+        'normalized': pd.concat([normalized for _, normalized, _ in results], keys=mapped_population.keys()),
+        'absolute': pd.concat([absolute for _, _, absolute in results], keys=mapped_population.keys()),
+        'timezones': pd.Series({country: timezone(macro_countries[country]) for country in mapped_population.keys()})
+    }
 
-        # Localize Timestamps (including daylight saving time correction)
-        df_country = localize(df[macro_country], macro_country)
 
-        normalized = []
-        absolute = []
-        for building_type, building_data in building_database.items():
+def region_finishing(df, country, population, macro_country, building_database, sums=None):
 
-            # Weighting
-            df_cb = df_country[building_type] * population
+    # Localize Timestamps (including daylight saving time correction)
+    df_country = localize(df[macro_country], macro_country)
+
+    weighted = []
+    normalized = {}
+    absolute = {}
+    for building_type, building_data in building_database.items():
+
+        # Weighting
+        df_cb = df_country[building_type] * population
+        weighted.append(df_cb.astype('float32'))
+
+        # Yearly sums, unless given for a period exceeding df (see yearly_sums)
+        if sums is None:
+            yearly = df_cb.groupby(df_cb.index.year).sum().sum(axis=1)
+        else:
+            yearly = sums.loc[(country, building_type)].dropna()
+
+        # Scaling to 1 TWh/a
+        years = df_cb.index.year.unique()
+        normalized[building_type] = 1000000 / yearly.sum() * len(yearly)
+
+        # Scaling to building database
+        database_years = building_data.columns
+        absolute[building_type] = pd.Series([
+            1000000 / yearly[year] * building_data.loc[country, str(year)]
+            if str(year) in database_years else float('nan')
+            for year in years
+        ], index=years)
+
+    # Change index to UCT
+    return (pd.concat(weighted, axis=1, keys=building_database.keys()).tz_convert('utc'),
+            pd.Series(normalized), pd.DataFrame(absolute).transpose())
+
+
+def spatial_unit(spatial, unit):
+
+    # Spatial time series (see finishing) either normalized to 1 TWh/a ('MW/TWh')
+    # or scaled to the building database ('MW')
+    weighted = spatial['weighted']
+
+    if unit == 'MW/TWh':
+        factors = spatial['normalized'].reindex(weighted.columns.droplevel(['latitude', 'longitude'])).values
+        values = weighted.values * factors.astype(weighted.values.dtype)
+    else:
+        values = weighted.values.copy()
+        for key, factors in absolute_factors(spatial, weighted.index):
+            values[:, weighted.columns.get_loc(key)] *= factors[:, np.newaxis]
+
+    return pd.DataFrame(values, index=weighted.index, columns=weighted.columns)
 
-            # Scaling to 1 TWh/a
-            years = df_cb.index.year.unique()
-            factor = 1000000 / df_cb.sum().sum() * len(years)
-            normalized.append(df_cb.multiply(factor))
 
-            # Scaling to building database
-            database_years = building_data.columns
-            factors = pd.Series([
-                1000000 / df_cb.loc[df_cb.index.year == year, ].sum().sum() * building_data.loc[country, str(year)]
-                if str(year) in database_years else float('nan')
-                for year in years
-            ], index=years)
-            absolute.append(df_cb.multiply(
-                pd.Series(factors.loc[df_cb.index.year].values, index=df_cb.index), axis=0, fill_value=None
-            ))
+def spatial_aggregation(spatial):
 
-        country_results = pd.concat(
-            [pd.concat(x, axis=1, keys=building_database.keys()) for x in [normalized, absolute]],
-            axis=1, keys=['MW/TWh', 'MW']
-        ).apply(pd.to_numeric, downcast='float')
+    # Sums over all locations in both units by country, unit and building type
+    # The factors are applied to the sums of the weighted time series
+    weighted = group_df_by_multiple_column_levels(spatial['weighted'], ['country', 'building_type'])
 
-        # Change index to UCT
-        results.append(country_results.tz_convert('utc'))
+    normalized = weighted * spatial['normalized'].reindex(weighted.columns).values.astype(weighted.values.dtype)
+    absolute = weighted.copy()
+    for key, factors in absolute_factors(spatial, weighted.index):
+        absolute[key] *= factors.astype(weighted.values.dtype)
 
-    return pd.concat(results, keys=mapped_population.keys(), axis=1,
-                     names=['country', 'unit', 'building_type', 'latitude', 'longitude'])
+    df = pd.concat([absolute, normalized], axis=1, keys=['MW', 'MW/TWh'], names=['unit', 'country', 'building_type'])
+
+    return df.reorder_levels(['country', 'unit', 'building_type'], axis=1).sort_index(axis=1)
+
+
+def absolute_factors(spatial, index):
+
+    # Factors by which the weighted time series are scaled to the building database, per time step of index
+    # as ((country, building type), factors), these depending on the local year of the respective region
+    for country, region_timezone in spatial['timezones'].items():
+        years = index.tz_convert(region_timezone).year
+        for (_, building_type), factors in spatial['absolute'].loc[[country]].iterrows():
+            yield (country, building_type), factors.reindex(years).values
+
+
+def yearly_sums(df, mapped_population, regions):
+
+    # Sums of the weighted time series per local year, by region and building type
+    # These can be passed to finishing for scaling time chunks of a longer period
+    sums = {}
+    for country, population in mapped_population.items():
+
+        macro_country = regions.loc[regions.id == country]['country_code'].values[0]
+        df_country = localize(df[macro_country], macro_country)
+
+        for building_type in buildings:
+            df_cb = df_country[building_type] * population
+            sums[(country, building_type)] = df_cb.groupby(df_cb.index.year).sum().sum(axis=1)
+
+    return pd.DataFrame(sums).transpose()
 
 
 def combine(space, water):
 
+    return arrangement(aggregation(space, water))
+
+
+def aggregation(space, water):
+
     # Spatial aggregation
-    space = group_df_by_multiple_column_levels(space, ['country', 'unit', 'building_type'])
-    water = group_df_by_multiple_column_levels(water, ['country', 'unit', 'building_type'])
-
-    # Merge space and water
-    df = pd.concat([space, water], axis=1, keys=['space', 'water'],
-                   names=['attribute', 'country', 'unit', 'building_type'])
-
-    # Aggregation of building types for absolute values
-    dfx = df.loc[:, df.columns.get_level_values('unit') == 'MW']
-    dfx = dfx.groupby(dfx.columns.droplevel('building_type'), axis=1).sum()
-    dfx.columns = pd.MultiIndex.from_tuples(dfx.columns)
-    dfx = pd.concat([dfx['space'], dfx['water'], dfx['space'] + dfx['water']], axis=1,
-                    keys=['space', 'water', 'total'], names=['attribute', 'country', 'unit'])
-
-    # Rename columns
-    df.columns = pd.MultiIndex.from_tuples(
-        [('_'.join([level for level in [col_name[0], col_name[3]]]), col_name[1], col_name[2])
-         for col_name in df.columns.values]
+    sums = {'space': spatial_aggregation(space), 'water': spatial_aggregation(water)}
+
+    # The final columns (country, variable, attribute, unit) are sorted up front, so that each time series
+    # is written to its final position in a single array
+    columns = sorted(
+        [(country, 'heat_demand' if unit == 'MW' else 'heat_profile', '_'.join([heat_type, building_type]), unit)
+         for heat_type, df in sums.items() for country, unit, building_type in df.columns]
+        + [(country, 'heat_demand', attribute, 'MW')
+           for country in sums['space'].columns.get_level_values('country').unique()
+           for attribute in ['space', 'water', 'total']]
     )
+    positions = {column: position for position, column in enumerate(columns)}
+
+    index = sums['space'].index
+    values = np.empty((len(index), len(columns)), dtype=np.result_type(*[df.values.dtype for df in sums.values()]))
+
+    for country in sums['space'].columns.get_level_values('country').unique():
+        total = 0
+        for heat_type, df in sums.items():
+
+            # Building-specific time series
+            absolute = 0
+            for _, unit, building_type in df.columns[df.columns.get_level_values('country') == country]:
+                variable = 'heat_demand' if unit == 'MW' else 'heat_profile'
+                series = df[(country, unit, building_type)].values
+                values[:, positions[(country, variable, '_'.join([heat_type, building_type]), unit)]] = series
+
+                # Aggregation of building types for absolute values, missing values not counting
+                if unit == 'MW':
+                    absolute = absolute + np.nan_to_num(series)
+
+            values[:, positions[(country, 'heat_demand', heat_type, 'MW')]] = absolute
+            total = total + absolute
 
-    # Combine building-specific and aggregated time series, round, restore nan
-    df = pd.concat([dfx, df], axis=1).round()
-    df.replace(0, float('nan'), inplace=True)
+        values[:, positions[(country, 'heat_demand', 'total', 'MW')]] = total
+
+    # Round, restore nan
+    values.round(out=values)
+    values[values == 0] = float('nan')
+
+    return pd.DataFrame(values, index=index, columns=pd.MultiIndex.from_tuples(
+        columns, names=['country', 'variable', 'attribute', 'unit']
+    ))
+
+
+def arrangement(df):
+
+    values = df.values.copy()
 
     # Fill NA at the end and the beginning of the dataset arising from different local times
-    df_short = df.loc[:, df.columns.get_level_values('unit') == 'MW'].copy().dropna(how='all')
-    df = df.fillna(method='bfill').fillna(method='ffill')
-    df[df_short.columns] = df_short.fillna(method='bfill').fillna(method='ffill')
-
-    # Swap MultiIndex
-    df = pd.concat([
-        df.loc[:, df.columns.get_level_values('unit') == 'MW'],
-        df.loc[:, df.columns.get_level_values('unit') == 'MW/TWh']
-    ], axis=1, keys=['heat_demand', 'heat_profile'])
-    df = df.swaplevel(i=0, j=2, axis=1)
-    df = df.swaplevel(i=1, j=2, axis=1)
-    df = df.sort_index(level=0, axis=1)
-    df.columns.names = ['country', 'variable', 'attribute', 'unit']
-
-    return df
+    # Absolute values are only filled in time steps with any absolute value
+    absolute = np.flatnonzero(df.columns.get_level_values('unit') == 'MW')
+    profiles = np.flatnonzero(df.columns.get_level_values('unit') != 'MW')
+    rows = np.flatnonzero(~np.isnan(values[:, absolute]).all(axis=1))
+
+    fill_gaps(values, profiles)
+    fill_gaps(values, absolute, rows)
+
+    return pd.DataFrame(values, index=df.index, columns=df.columns)
@@ -1,59 +1,132 @@
 
 import pytz
+import numpy as np
 import pandas as pd
 import pycountry
+from scipy import sparse
 
 
 def get_alpha2(alpha3):
     return pycountry.countries.get(alpha_3=alpha3).alpha_2
 
 
-def localize(df, country, ambiguous=None):
+# Row positions and localized index by time zone and naive index (see localization)
+localizations = {}
 
-    # The exceptions below correct for daylight saving time
-    try:
-        df.index = df.index.tz_localize(pytz.country_timezones[country][0], ambiguous=ambiguous)
-        return df
 
-    # Delete values that do not exist because of daylight saving time
-    except pytz.NonExistentTimeError as err:
-        return localize(df.loc[df.index != err.args[0], ], country)
+def timezone(country):
 
-    # Duplicate values that exist twice because of daylight saving time
-    except pytz.AmbiguousTimeError as err:
-        idx = pd.Timestamp(err.args[0].split("'")[1])
-        unambiguous_df = localize(df.loc[df.index != idx, ], country)
-        ambiguous_df = localize(df.loc[[idx, idx], ], country, ambiguous=[True, False])
-        return unambiguous_df.append(ambiguous_df).sort_index()
+    # Time zone by which the data of a country is localized
+    return pytz.country_timezones[country][0]
+
+
+def localize(df, country):
+
+    # The mapping from the naive to the localized index is computed once per time zone and index
+    # and applied by a single positional take
+    key = (timezone(country), df.index.asi8.tobytes())
+    if key not in localizations:
+        localizations[key] = localization(df.index, key[0])
+    positions, index = localizations[key]
+
+    df = df.iloc[positions]
+    df.index = index
+
+    return df
+
+
+def localization(index, timezone):
+
+    # Each naive local time is matched with all UTC times at which it occurs, i.e. with the UTC time for each offset
+    # of the time zone that converts back to it. This corrects for daylight saving time: values that do not exist
+    # are deleted and values that exist twice are duplicated
+    utc = pd.date_range(index.min() - pd.Timedelta(days=1), index.max() + pd.Timedelta(days=1), freq='H', tz='utc')
+    offsets = np.unique(utc.tz_convert(timezone).tz_localize(None).asi8 - utc.tz_localize(None).asi8)
+
+    positions = []
+    times = []
+    for offset in offsets:
+        candidates = index.asi8 - offset
+        valid = pd.DatetimeIndex(candidates, tz='utc').tz_convert(timezone).tz_localize(None).asi8 == index.asi8
+        positions.append(np.flatnonzero(valid))
+        times.append(candidates[valid])
+
+    positions = np.concatenate(positions)
+    times = np.concatenate(times)
+    order = np.argsort(times, kind='mergesort')
+
+    return positions[order], pd.DatetimeIndex(times[order], tz='utc', name=index.name).tz_convert(timezone)
 
 
 def upsample_df(df, resolution):
 
     # The low-resolution values are applied to all high-resolution values up to the next low-resolution value
     # In particular, the last low-resolution value is extended up to where the next low-resolution value would be
+    index, positions = upsample_index(df.index, resolution)
 
-    df = df.copy()
+    # Each low-resolution row is repeated as often as it holds in the high resolution
+    values = np.repeat(df.values, np.bincount(positions, minlength=len(df)), axis=0)
 
-    # Determine the original frequency
-    freq = df.index[-1] - df.index[-2]
+    return pd.DataFrame(values, index=index, columns=df.columns)
 
-    # Temporally append the DataFrame by one low-resolution value
-    df.loc[df.index[-1] + freq, :] = df.iloc[-1, :]
-    dtidx = pd.date_range(str(df.index[0]),str(df.index[-1]), freq=freq)
-    df.index = dtidx
-    
-    # Up-sample
-    df = df.resample(resolution).pad()
 
-    # Drop the temporal low-resolution value
-    df.drop(df.index[-1], inplace=True)
+def upsample_index(index, resolution):
 
-    return df
+    # High-resolution index and, for each of its time steps, the position of the low-resolution value holding there
+    # Indexing with these positions allows to use low-resolution data in the high resolution without upsampling
+    freq = index[-1] - index[-2]
+    upsampled = pd.date_range(index[0], index[-1] + freq, freq=resolution, closed='left', name=index.name)
+
+    return upsampled, index.searchsorted(upsampled, side='right') - 1
+
+
+def fill_gaps(values, columns, rows=None):
+
+    # Missing values in the given columns (and optionally rows) of a 2D array are filled in place with the next
+    # valid value, or with the last valid value at the end, as by a backward fill followed by a forward fill
+    rows = slice(None) if rows is None else rows
+    for column in columns:
+        series = values[rows, column]
+        missing = np.isnan(series)
+        valid = np.flatnonzero(~missing)
+        if missing.any() and len(valid):
+            following = np.minimum(valid.searchsorted(np.flatnonzero(missing)), len(valid) - 1)
+            series[missing] = series[valid[following]]
+            values[rows, column] = series
+
+
+# Aggregation operators by column layout, kept levels and data type (see aggregation_operator)
+aggregation_operators = {}
 
 
 def group_df_by_multiple_column_levels(df, column_levels):
 
-    df = df.groupby(df.columns.droplevel(list(set(df.columns.names) - set(column_levels))), axis=1).sum()
-    df.columns = pd.MultiIndex.from_tuples(df.columns, names=column_levels)
+    values = df.values
+    operator, columns = aggregation_operator(df.columns, column_levels, np.result_type(values.dtype, np.float32))
 
-    return df
+    # Missing values are skipped in the sums
+    if np.isnan(values).any():
+        values = np.where(np.isnan(values), 0, values)
+
+    # The columns are summed by a single sparse matrix product, the result being (column, time)
+    return pd.DataFrame(operator.dot(values.T).T, index=df.index, columns=columns)
+
+
+def aggregation_operator(columns, column_levels, dtype):
+
+    # Sparse matrix that sums all columns with the same labels in the kept levels, i.e. of shape (group, column),
+    # and the MultiIndex of the groups, sorted as by a groupby
+    # The operator is computed once and reused for all DataFrames with the same columns
+    key = (tuple(columns.names), tuple(column_levels), np.dtype(dtype).str,
+           pd.util.hash_pandas_object(columns, index=False).values.tobytes())
+
+    if key not in aggregation_operators:
+        groups = columns.droplevel(list(set(columns.names) - set(column_levels)))
+        unique_groups = groups.unique().sort_values()
+        operator = sparse.csr_matrix(
+            (np.ones(len(columns), dtype=dtype), (unique_groups.get_indexer(groups), np.arange(len(columns)))),
+            shape=(len(unique_groups), len(columns))
+        )
+        aggregation_operators[key] = operator, pd.MultiIndex.from_tuples(list(unique_groups), names=column_levels)
+
+    return aggregation_operators[key]
@@ -0,0 +1,68 @@
+import numpy as np
+import pandas as pd
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+
+# Shared memory is only available from Python 3.8 on, before which the frames are pickled once for each worker
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+
+# DataFrames attached to shared memory in a worker process
+attached = {}
+
+
+def starmap(func, frames, tasks, workers=1, **kwargs):
+
+    # func is called with the frames, the keyword arguments of each task and the common keyword arguments
+    if workers == 1:
+        return [func(**frames, **task, **kwargs) for task in tasks]
+
+    # The values of the frames are placed in shared memory once, from where they are attached by each worker
+    # instead of being pickled with each task
+    blocks = []
+    try:
+        descriptors = {}
+        for name, df in frames.items():
+            if shared_memory is None:
+                descriptors[name] = df
+                continue
+
+            # The memory order of the values is kept, so that the workers compute on the same layout as
+            # a single process and no contiguous copy is made
+            values = df.values
+            order = 'F' if values.flags.f_contiguous and not values.flags.c_contiguous else 'C'
+            block = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+            blocks.append(block)
+            np.ndarray(values.shape, values.dtype, buffer=block.buf, order=order)[:] = values
+            descriptors[name] = (block.name, values.shape, values.dtype, order, df.index, df.columns)
+
+        with ProcessPoolExecutor(max_workers=workers, initializer=attach, initargs=(descriptors,)) as executor:
+            return list(executor.map(partial(run, func, **kwargs), tasks))
+
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+
+def attach(descriptors):
+
+    for name, descriptor in descriptors.items():
+        if isinstance(descriptor, pd.DataFrame):
+            attached[name] = None, descriptor
+            continue
+
+        block_name, shape, dtype, order, index, columns = descriptor
+        block = shared_memory.SharedMemory(name=block_name)
+
+        attached[name] = block, pd.DataFrame(np.ndarray(shape, dtype, buffer=block.buf, order=order),
+                                             index=index, columns=columns, copy=False)
+
+
+def run(func, task, **kwargs):
+
+    # Results of func must not be views of the shared frames
+    return func(**{name: df for name, (_, df) in attached.items()}, **task, **kwargs)
@@ -0,0 +1,143 @@
+import pandas as pd
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+
+import scripts.read as read
+import scripts.preprocess as preprocess
+import scripts.demand as demand
+import scripts.cop as cop
+import scripts.store as store
+
+
+def out_of_core(input_path, store_path, year_start, year_end, mapped_population, wind, regions, workers=1):
+
+    # Out-of-core alternative to the in-memory processing of heat demand and COP
+    # Spatial time series are computed year by year and spilled to disk, from where they are aggregated
+    # by UTC year, so that memory requirements do not grow with the number of years
+    # With more than one worker, the years are sharded across a process pool
+    store.clear(store_path)
+
+    parameters = {
+        'daily': read.daily_parameters(input_path),
+        'hourly': read.hourly_parameters(input_path),
+        'cop': read.cop_parameters(input_path)
+    }
+    building_database = read.building_database(input_path)
+    years = list(range(year_start, year_end+1))
+
+    if workers == 1:
+        # The daily average temperatures of the three preceding days are carried over from year to year
+        state = None
+        sums = []
+        for year in years:
+            state, year_sums = spatial_chunk(input_path, store_path, year, state,
+                                             mapped_population, wind, regions, parameters)
+            sums.append(year_sums)
+
+    else:
+        # Each year starts from a lead-in of the three preceding days instead
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            sums = list(executor.map(
+                partial(spatial_shard, input_path, store_path, year_start=year_start,
+                        mapped_population=mapped_population, wind=wind, regions=regions, parameters=parameters),
+                years
+            ))
+
+    # Scaling in demand.finishing requires the weighted sums of all years
+    sums = {
+        heat_type: pd.concat([year_sums[heat_type] for year_sums in sums], axis=1)
+        for heat_type in ['space', 'water']
+    }
+
+    # The first and the last chunk are open-ended to keep the time steps from the time zone offsets
+    starts = [None] + [pd.Timestamp(year=year, month=1, day=1, tz='utc') for year in years[1:]]
+    ends = starts[1:] + [None]
+    aggregation = partial(aggregation_chunk, store_path, mapped_population=mapped_population, regions=regions,
+                          building_database=building_database, sums=sums)
+
+    if workers == 1:
+        results = list(map(aggregation, starts, ends))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(aggregation, starts, ends))
+
+    # The per-year results are merged in order into the final heat time series
+    # and the uncorrected COP, which is to be passed to cop.arrangement
+    heat = demand.arrangement(pd.concat([year_heat for year_heat, _ in results]))
+    cop_ratio = pd.concat([year_cop for _, year_cop in results])
+
+    return heat, cop_ratio
+
+
+def spatial_shard(input_path, store_path, year, year_start, mapped_population, wind, regions, parameters):
+
+    # The reference temperature of a year requires the daily average temperatures of the three preceding days
+    if year == year_start:
+        state = None
+    else:
+        lead_in = preprocess.temperature(input_path, year-1, year-1, mapped_population,
+                                         start=pd.Timestamp(year=year-1, month=12, day=29))
+        state = demand.daily_average(lead_in['air']).values[-3:]
+
+    _, sums = spatial_chunk(input_path, store_path, year, state, mapped_population, wind, regions, parameters)
+
+    return sums
+
+
+def spatial_chunk(input_path, store_path, year, state, mapped_population, wind, regions, parameters):
+
+    print('Spatial heat demand and COP of {} are calculated and written to the store.'.format(year))
+
+    temperature = preprocess.temperature(input_path, year, year, mapped_population)
+
+    # Reference temperature, continuing from the state of the previous year
+    daily_temperature = demand.daily_average(temperature['air'])
+    reference_temperature = demand.reference_temperature(daily_temperature, state, averaged=True)
+
+    # Heat demand
+    daily_heat = demand.daily_heat(reference_temperature, wind, parameters['daily'])
+    daily_water = demand.daily_water(reference_temperature, wind, parameters['daily'])
+    hourly_space, hourly_water = demand.hourly_space_water(daily_heat, daily_water, reference_temperature,
+                                                           parameters['hourly'])
+
+    store.write(store_path, 'hourly_space', year, hourly_space)
+    store.write(store_path, 'hourly_water', year, hourly_water)
+
+    sums = {
+        'space': demand.yearly_sums(hourly_space, mapped_population, regions),
+        'water': demand.yearly_sums(hourly_water, mapped_population, regions)
+    }
+
+    # COP
+    spatial_cop = cop.spatial_cop(temperature, cop.source_temperature(), cop.sink_temperature(), parameters['cop'])
+    store.write(store_path, 'spatial_cop', year, spatial_cop)
+
+    return daily_temperature.values[-3:], sums
+
+
+def aggregation_chunk(store_path, start, end, mapped_population, regions, building_database, sums):
+
+    # The UTC window [start, end) is read from the local-time chunks with a margin of one day for the time zones
+    window = {
+        'start': None if start is None else start.tz_localize(None) - pd.Timedelta(days=1),
+        'end': None if end is None else end.tz_localize(None) + pd.Timedelta(days=1)
+    }
+
+    def utc_window(df):
+        first = 0 if start is None else df.index.searchsorted(start)
+        last = len(df.index) if end is None else df.index.searchsorted(end)
+        return df.iloc[first:last]
+
+    # Only the weighted time series of the spatial demand are time series (see demand.finishing)
+    spatial_space = demand.finishing(store.read(store_path, 'hourly_space', **window),
+                                     mapped_population, building_database['space'], regions, sums['space'])
+    spatial_space['weighted'] = utc_window(spatial_space['weighted'])
+    spatial_water = demand.finishing(store.read(store_path, 'hourly_water', **window),
+                                     mapped_population, building_database['water'], regions, sums['water'])
+    spatial_water['weighted'] = utc_window(spatial_water['weighted'])
+
+    heat = demand.aggregation(spatial_space, spatial_water)
+    cop_ratio = utc_window(cop.aggregation(store.read(store_path, 'spatial_cop', **window),
+                                         spatial_space, spatial_water))
+
+    return heat, cop_ratio
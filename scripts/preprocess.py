@@ -1,89 +1,143 @@
 
 import os
+import numpy as np
 import pandas as pd
 import geopandas as gpd
+from concurrent.futures import ProcessPoolExecutor
 from shapely.geometry import Point
 
 import scripts.read as read
+import scripts.cache as cache
 from scripts.misc import upsample_df
 
 
-def map_population(input_path, regions, interim_path, plot=True):
+def map_population(input_path, regions, interim_path, plot=True, workers=1):
 
     mapped_population = {}
 
-    population = read.population(input_path)
-    weather_data = read.wind(input_path)  # For the weather grid
+    # Population and weather grid are only read and re-mapped if any of the regions is not in the cache,
+    # in which case all regions are re-mapped in one pass
+    remapped = {}
 
-    # Make GeoDataFrame from the weather data coordinates
-    weather_grid = gpd.GeoDataFrame(index=weather_data.columns)
-    weather_grid['geometry'] = weather_grid.index.map(lambda i: Point(reversed(i)))
+    def remap(region_id):
+        if not remapped:
+            remapped.update(regions_population(read.population(input_path, interim_path, set(country_codes(regions))),
+                                               read.grid(input_path), regions, workers))
+        return remapped[region_id]
 
-    # Set coordinate reference system to 'latitude/longitude'
-    weather_grid.crs = {'init': 'epsg:4326'}
+    for index, region in regions.iterrows():
+        print(region.id)
 
-    # Make polygons around the weather points
-    weather_grid['geometry'] = weather_grid.geometry.apply(lambda point: point.buffer(.75 / 2, cap_style=3))
+        # The re-mapped population is cached by the population and weather data and by the region's shape
+        key = cache.key(
+            cache.files(read.population_file(input_path), os.path.join(input_path, 'weather', 'ERA_wind.nc')),
+            region.id, region.country_code, region.geometry.wkb
+        )
+        mapped_population[region.id] = cache.cached(os.path.join(interim_path, 'cache'),
+                                                    'population_{}'.format(region.id), key, remap, region.id)
 
-    # Make list from MultiIndex (this is necessary for the spatial join)
-    weather_grid.index = weather_grid.index.tolist()
+    if plot:
+        print('Plot of the re-mapped population data of {} (first selected country) '
+              'for visual inspection:'.format(regions.id.values[0]))
+        gdf = gpd.GeoDataFrame(mapped_population[regions.id.values[0]], columns=['TOT_P'])
+        gdf['geometry'] = gdf.index.map(lambda i: Point(reversed(i)))
+        gdf.plot(column='TOT_P')
 
-    for region in regions.iterrows():
-        print(region[1].id)
-        file = os.path.join(interim_path, 'population_{}'.format(region[1].id))
+    return mapped_population
 
-        if not os.path.isfile(file):
-            # For Luxembourg, a single weather grid point is manually added for lack of population geodata
-            if region[1].id == 'LU':
-                s = pd.Series({(49.5, 6): 1})
 
-            else:
-                # Filter population data by country to cut processing time
-                if region[1].id == 'GB':
-                    gdf = population[population.CNTR_CODE == 'UK'].copy()
-                else:
-                    gdf = population[population.CNTR_CODE == region[1].country_code].copy()
+def regions_population(population, weather_grid, regions, workers=1):
 
-                # Align coordinate reference systems
-                gdf = gdf.to_crs({'init': 'epsg:4326'})
-                print(gdf)
+    # Population data of each region is restricted to its country
+    codes = country_codes(regions)
 
-                # Spatial join, first to the region, then to the weather grid points
-                region_points = gpd.sjoin(
-                    gdf, regions.loc[[region[0]]], how="left", op='within'
-                )
-                weather_grid_points = gpd.sjoin(
-                    region_points.dropna().drop('index_right', axis=1),
-                    weather_grid, how="left", op='within'
-                )
+    # Population points of all countries are reprojected once
+    gdf = population[population.CNTR_CODE.isin(codes) & population.TOT_P.notnull()]
+    gdf = gdf.to_crs({'init': 'epsg:4326'})
+    latitude = gdf.geometry.apply(lambda point: point.y).values
+    longitude = gdf.geometry.apply(lambda point: point.x).values
 
+    # All points are assigned to the regions by a spatial join with a single spatial index over the region shapes,
+    # optionally split into tiles of neighbouring longitudes that are joined in parallel
+    shapes = regions[['geometry']].reset_index(drop=True)
+    tiles = np.array_split(np.argsort(longitude, kind='mergesort'), min(workers, max(len(gdf), 1)))
+    if workers == 1:
+        joined = [region_join(gdf.iloc[tile], shapes) for tile in tiles]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            joined = list(executor.map(region_join, [gdf.iloc[tile] for tile in tiles], [shapes] * len(tiles)))
+    points = np.concatenate([tile[tile_points] for tile, (tile_points, _) in zip(tiles, joined)])
+    shape_positions = np.concatenate([tile_shapes for _, tile_shapes in joined])
 
-                # Sum up population
-                s = weather_grid_points.groupby('index_right')['TOT_P'].sum()
+    # Points outside their region's country are discarded
+    same_country = gdf.CNTR_CODE.values[points] == codes[shape_positions]
+    points, shape_positions = points[same_country], shape_positions[same_country]
 
-            # Write results to interim path
-            s.to_pickle(file)
+    # Population points are binned to the weather grid cells by their coordinates
+    cells = grid_cells(latitude[points], longitude[points], weather_grid)
+    inside = cells >= 0
 
-        else:
+    # Sum up population by region and weather grid cell
+    keys, inverse = np.unique(shape_positions[inside] * len(weather_grid) + cells[inside], return_inverse=True)
+    total = np.bincount(inverse, weights=gdf.TOT_P.values[points][inside], minlength=len(keys))
+    bounds = np.searchsorted(keys, np.arange(len(regions) + 1) * len(weather_grid))
 
-            s = pd.read_pickle(file)
-            print('{} already exists and is read from disk.'.format(file))
+    population = {}
+    for position, region_id in enumerate(regions.id.values):
+        region_keys = slice(bounds[position], bounds[position + 1])
+        population[region_id] = pd.Series(
+            total[region_keys].astype(gdf.TOT_P.dtype),
+            index=weather_grid[keys[region_keys] % len(weather_grid)], name='TOT_P'
+        ).sort_index()
 
-        mapped_population[region[1].id] = s
+    # For Luxembourg, a single weather grid point is manually added for lack of population geodata
+    if 'LU' in population:
+        population['LU'] = pd.Series({(49.5, 6): 1})
 
-    if plot:
-        print('Plot of the re-mapped population data of {} (first selected country) '
-              'for visual inspection:'.format(regions.id.values[0]))
-        gdf = gpd.GeoDataFrame(mapped_population[regions.id.values[0]], columns=['TOT_P'])
-        gdf['geometry'] = gdf.index.map(lambda i: Point(reversed(i)))
-        gdf.plot(column='TOT_P')
+    return population
 
-    return mapped_population
+
+def country_codes(regions):
+
+    # Country codes of the regions in the population data, in which GB is UK
+    return np.where(regions.id.values == 'GB', 'UK', regions.country_code.values)
+
+
+def region_join(gdf, shapes):
+
+    # Positions of the points and of the shapes within which they are
+    joined = gpd.sjoin(gdf[['geometry']].reset_index(drop=True), shapes, how='inner', op='within')
+    return joined.index.values, joined['index_right'].values
+
+
+def grid_cells(latitude, longitude, weather_grid):
+
+    # Position of each coordinate's cell in the weather grid or -1 if it is in none of the cells,
+    # the cells being squares of the grid resolution around the grid points
+    latitudes = np.unique(weather_grid.get_level_values('latitude'))
+    longitudes = np.unique(weather_grid.get_level_values('longitude'))
+    resolution = latitudes[1] - latitudes[0]
+
+    rows = np.rint((latitude - latitudes[0]) / resolution).astype(int)
+    cols = np.rint((longitude - longitudes[0]) / resolution).astype(int)
+    inside = (rows >= 0) & (rows < len(latitudes)) & (cols >= 0) & (cols < len(longitudes))
+    rows, cols = rows.clip(0, len(latitudes) - 1), cols.clip(0, len(longitudes) - 1)
+
+    # Points on a cell border are not within any cell
+    inside &= (np.abs(latitude - latitudes[rows]) < resolution / 2) & \
+              (np.abs(longitude - longitudes[cols]) < resolution / 2)
+
+    # Grid points by row and column
+    positions = np.full((len(latitudes), len(longitudes)), -1)
+    positions[latitudes.searchsorted(weather_grid.get_level_values('latitude')),
+              longitudes.searchsorted(weather_grid.get_level_values('longitude'))] = np.arange(len(weather_grid))
+
+    return np.where(inside, positions[rows, cols], -1)
 
 
 def wind(input_path, mapped_population, plot=True):
 
-    df = read.wind(input_path)
+    df = read.wind(input_path, locations(mapped_population))
 
     # Temporal average
     s = df.mean(0)
@@ -101,28 +155,35 @@ def wind(input_path, mapped_population, plot=True):
     ).apply(pd.to_numeric, downcast='float')
 
 
-def temperature(input_path, year_start, year_end, mapped_population):
+def temperature(input_path, year_start, year_end, mapped_population, start=None, end=None):
 
     parameters = {
         'air': 't2m',
         'soil': 'stl4'
     }
 
-    t = pd.concat(
-        [read.temperature(input_path, year_start, year_end, parameter) for parameter in parameters.values()],
-        keys=parameters.keys(), names=['parameter', 'latitude', 'longitude'], axis=1
+    t = read.temperatures(input_path, year_start, year_end, parameters, locations(mapped_population), start, end)
+
+    # Temperature data is filtered by country before upsampling
+    columns = pd.MultiIndex.from_tuples(
+        [(parameter, country) + location
+         for parameter in parameters.keys()
+         for country, population in mapped_population.items()
+         for location in population.index],
+        names=['parameter', 'country', 'latitude', 'longitude']
     )
+    positions = t.columns.get_indexer(pd.MultiIndex.from_tuples(
+        [(column[0],) + column[2:] for column in columns]
+    ))
 
-    t = upsample_df(t, '60min')
+    return upsample_df(pd.DataFrame(t.values[:, positions].astype('float32'), index=t.index, columns=columns), '60min')
+
+
+def locations(mapped_population):
+
+    # All weather grid points with population in any of the regions
+    return set(location for population in mapped_population.values() for location in population.index)
 
-    # Temperature data is filtered by country
-    return pd.concat(
-        [pd.concat(
-            [t[parameter][population.index] for population in mapped_population.values()],
-            keys=mapped_population.keys(), axis=1
-        ) for parameter in parameters.keys()],
-        keys=parameters.keys(), names=['parameter', 'country', 'latitude', 'longitude'], axis=1
-    ).apply(pd.to_numeric, downcast='float')
 
 #%% Custom temperature
 
@@ -1,62 +1,189 @@
 
 import os
+import shutil
 import pandas as pd
 import geopandas as gpd
 import copy
+import numpy as np
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
 from netCDF4 import Dataset, num2date
 from shapely.geometry import Point
 
 from scripts.misc import get_alpha2
 
-def temperature(input_path, year_start, year_end, param):
 
-    return pd.concat(
-        [weather(input_path, 'ERA_temperature_{}.nc'.format(year), param) for year in range(year_start, year_end+1)],
-        axis=0
-    )
+# Units of CF time variables and their pandas equivalents
+time_units = {'days': 'D', 'hours': 'h', 'minutes': 'm', 'seconds': 's'}
+
+
+def wind(input_path, locations=None):
+
+    return weather(input_path, 'ERA_wind.nc', 'si10', locations)
+
+
+def temperatures(input_path, year_start, year_end, parameters, locations=None, start=None, end=None, workers=None):
+
+    # Each yearly file is opened once and all parameters (name: netCDF variable) are read from it
+    datasets = [Dataset(os.path.join(input_path, 'weather', 'ERA_temperature_{}.nc'.format(year)))
+                for year in range(year_start, year_end+1)]
 
+    try:
+        # Masking and scaling is done after reading (see read_variable)
+        for nc in datasets:
+            nc.set_auto_maskandscale(False)
+        lock = Lock()
 
-def wind(input_path):
+        # The time steps of each year within the optional time window determine its position in a single block
+        times = [decode_time(nc.variables['time']) for nc in datasets]
+        firsts = [0 if start is None else time.searchsorted(pd.Timestamp(start)) for time in times]
+        lasts = [len(time) if end is None else time.searchsorted(pd.Timestamp(end), side='right') for time in times]
+        times = [time[first:last] for time, first, last in zip(times, firsts, lasts)]
+        offsets = np.cumsum([0] + [len(time) for time in times])
+        columns, rows, cols = grid_selection(datasets[0], locations)
+        block = np.empty((offsets[-1], len(parameters), len(columns)), dtype='float32')
 
-    return weather(input_path, 'ERA_wind.nc', 'si10')
+        def read_year(i):
+            for j, variable_name in enumerate(parameters.values()):
+                block[offsets[i]:offsets[i+1], j] = read_variable(
+                    datasets[i].variables[variable_name], rows, cols, firsts[i], lasts[i], lock=lock
+                )
 
+        # The years are read in a thread pool, which barely speeds up reading: the lock serializes every netCDF read,
+        # so that only the unpacking runs in parallel
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(read_year, range(len(datasets))))
 
-def weather(input_path, filename, variable_name):
+    finally:
+        for nc in datasets:
+            nc.close()
+
+    return pd.DataFrame(
+        data=block.reshape(offsets[-1], -1),
+        index=times[0].append(times[1:]),
+        columns=pd.MultiIndex.from_tuples(
+            [(parameter,) + column for parameter in parameters.keys() for column in columns],
+            names=['parameter', 'latitude', 'longitude']
+        )
+    )
+
+
+def weather(input_path, filename, variable_name, locations=None, start=None, end=None):
 
     file = os.path.join(input_path, 'weather', filename)
 
     # Read the netCDF file
-    nc = Dataset(file)
-    time = nc.variables['time'][:]
-    time_units = nc.variables['time'].units
-    latitude = nc.variables['latitude'][:]
-    longitude = nc.variables['longitude'][:]
-    variable = nc.variables[variable_name][:]
+    with Dataset(file) as nc:
+        time = decode_time(nc.variables['time'])
+        columns, rows, cols = grid_selection(nc, locations)
+
+        # Only the time steps within the optional time window are read
+        first = 0 if start is None else time.searchsorted(pd.Timestamp(start))
+        last = len(time) if end is None else time.searchsorted(pd.Timestamp(end), side='right')
+
+        values = read_variable(nc.variables[variable_name], rows, cols, first, last)
 
     # Transform to pd.DataFrame
-    df = pd.DataFrame(data=variable.reshape(len(time), len(latitude) * len(longitude)),
-                      index=pd.Index(num2date(time, time_units), name='time'),
-                      columns=pd.MultiIndex.from_product([latitude, longitude],
-                                                         names=('latitude', 'longitude')))
+    df = pd.DataFrame(data=values, index=time[first:last], columns=columns)
 
     return df
 
 
-def population(input_path):
+def grid(input_path, filename='ERA_wind.nc'):
 
-    directory = 'population/Version 2_0_1/'
-    filename = 'GEOSTAT_grid_POP_1K_2011_V2_0_1.csv'
+    # All points of the weather grid, without reading any weather data
+    with Dataset(os.path.join(input_path, 'weather', filename)) as nc:
+        return grid_selection(nc)[0]
 
-    # Read population data
-    df = pd.read_csv(os.path.join(input_path, directory, filename),
-                     usecols=['GRD_ID', 'TOT_P', 'CNTR_CODE'],
-                     index_col='GRD_ID')
 
-    # Make GeoDataFrame from the the coordinates in the index
-    gdf = gpd.GeoDataFrame(df)
-    gdf['geometry'] = df.index.map(lambda i: Point(
-        [1000 * float(x) + 500 for x in reversed(i.split('N')[1].split('E'))]
-    ))
+def grid_selection(nc, locations=None):
+
+    latitude = nc.variables['latitude'][:]
+    longitude = nc.variables['longitude'][:]
+
+    if locations is None:
+        return pd.MultiIndex.from_product([latitude, longitude], names=('latitude', 'longitude')), None, None
+
+    # Grid indices of the required locations
+    columns = pd.MultiIndex.from_tuples(sorted(set(locations)), names=('latitude', 'longitude'))
+    rows = pd.Index(latitude).get_indexer(columns.get_level_values('latitude'))
+    cols = pd.Index(longitude).get_indexer(columns.get_level_values('longitude'))
+    if (rows < 0).any() or (cols < 0).any():
+        raise KeyError('Locations are not part of the weather grid in {}'.format(nc.filepath()))
+
+    return columns, rows, cols
+
+
+def read_variable(variable, rows=None, cols=None, first=None, last=None, lock=None):
+
+    # The netCDF library is not thread-safe, so with a lock the raw read is serialized
+    # and only masking and scaling in numpy run outside of it (automatic masking and scaling must be off)
+    def read(*key):
+        if lock is None:
+            return np.ma.filled(variable[key], np.nan)
+        with lock:
+            raw = variable[key]
+        return raw
+
+    if rows is None:
+        values = read(slice(first, last))
+        values = values.reshape(len(values), -1)
+
+    else:
+        # Only the hyperslab spanned by the required locations is read, from which these are picked
+        values = read(slice(first, last), slice(rows.min(), rows.max()+1), slice(cols.min(), cols.max()+1))
+        values = values[:, rows - rows.min(), cols - cols.min()]
+
+    return values if lock is None else unpack(variable, values)
+
+
+def unpack(variable, values):
+
+    # Masking and scaling as done automatically by netCDF4
+    fill_values = [getattr(variable, attr) for attr in ['_FillValue', 'missing_value'] if attr in variable.ncattrs()]
+    mask = np.isin(values, fill_values)
+    values = values * getattr(variable, 'scale_factor', 1.) + getattr(variable, 'add_offset', 0.)
+    values[mask] = np.nan
+
+    return values
+
+
+def decode_time(time):
+
+    # Standard calendars are decoded vectorized from units like 'hours since 1900-01-01 00:00:00.0'
+    if getattr(time, 'calendar', 'standard') in ['standard', 'gregorian', 'proleptic_gregorian']:
+        unit, origin = time.units.split(' since ')
+        offsets = pd.to_timedelta(np.asarray(time[:], dtype='float64'), unit=time_units[unit.strip()])
+        return pd.DatetimeIndex(pd.Timestamp(origin) + offsets, name='time')
+
+    return pd.Index(num2date(time[:], time.units, time.calendar), name='time')
+
+
+def population(input_path, interim_path, countries=None):
+
+    # The population data is read from a binary columnar copy of the CSV file, which is created on first use
+    # in the interim directory, so that it is not copied with the input data
+    file = population_file(input_path)
+    columnar_path = os.path.join(interim_path, os.path.splitext(os.path.basename(file))[0])
+    if not os.path.isdir(columnar_path) or os.path.getmtime(columnar_path) < os.path.getmtime(file):
+        write_population(file, columnar_path)
+
+    columns = {column: np.load(os.path.join(columnar_path, column + '.npy'), mmap_mode='r')
+               for column in ['easting', 'northing', 'TOT_P', 'CNTR_CODE']}
+
+    # Only the rows of the selected countries are loaded from the memory-mapped columns
+    if countries is None:
+        rows = slice(None)
+    else:
+        rows = np.flatnonzero(np.isin(columns['CNTR_CODE'], list(countries)))
+
+    # Make GeoDataFrame from the grid coordinates (1 km cells, represented by their centers)
+    gdf = gpd.GeoDataFrame({
+        'TOT_P': columns['TOT_P'][rows],
+        'CNTR_CODE': columns['CNTR_CODE'][rows]
+    }, columns=['TOT_P', 'CNTR_CODE'])
+    gdf['geometry'] = [Point(x, y) for x, y in zip((1000. * columns['easting'][rows] + 500).tolist(),
+                                                   (1000. * columns['northing'][rows] + 500).tolist())]
 
     # Transform coordinate reference system to 'latitude/longitude'
     gdf.crs = {'init': 'epsg:3035'}
@@ -64,6 +191,36 @@ def population(input_path):
     return gdf
 
 
+def population_file(input_path):
+
+    return os.path.join(input_path, 'population', 'Version 2_0_1', 'GEOSTAT_grid_POP_1K_2011_V2_0_1.csv')
+
+
+def write_population(file, columnar_path):
+
+    # Read population data
+    df = pd.read_csv(file, usecols=['GRD_ID', 'TOT_P', 'CNTR_CODE'])
+
+    # The grid coordinates in km are parsed from the grid IDs, e.g. 1kmN2689E4337
+    coordinates = df.GRD_ID.str.extract(r'N(\d+)E(\d+)', expand=True).astype('int32')
+
+    columns = {
+        'northing': coordinates[0].values,
+        'easting': coordinates[1].values,
+        'TOT_P': df.TOT_P.values,
+        'CNTR_CODE': df.CNTR_CODE.values.astype(str)
+    }
+
+    # Columns are written to a temporary directory first, so that incomplete copies are never read
+    temporary_path = columnar_path + '.tmp'
+    shutil.rmtree(temporary_path, ignore_errors=True)
+    os.makedirs(temporary_path)
+    for column, values in columns.items():
+        np.save(os.path.join(temporary_path, column + '.npy'), values)
+    shutil.rmtree(columnar_path, ignore_errors=True)
+    os.rename(temporary_path, columnar_path)
+
+
 def daily_parameters(input_path):
 
     file = os.path.join(input_path, 'bgw_bdew', 'daily_demand.csv')
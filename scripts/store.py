@@ -0,0 +1,57 @@
+import os
+import shutil
+import numpy as np
+import pandas as pd
+
+
+def write(store_path, stage, chunk, df):
+
+    # Each stage is a directory of time chunks, saved as .npy arrays of values and index
+    path = os.path.join(store_path, stage)
+    os.makedirs(path, exist_ok=True)
+
+    np.save(os.path.join(path, '{}.npy'.format(chunk)), np.ascontiguousarray(df.values))
+    np.save(os.path.join(path, '{}_index.npy'.format(chunk)), df.index.values)
+
+    # The column labels are saved with each chunk, which may be written by different processes
+    pd.to_pickle(df.columns, os.path.join(path, '{}_columns'.format(chunk)))
+
+
+def read(store_path, stage, start=None, end=None):
+
+    path = os.path.join(store_path, stage)
+
+    values = []
+    index = []
+    for chunk in chunks(store_path, stage):
+
+        # Only the rows within [start, end) are read from the memory-mapped chunks
+        chunk_index = pd.DatetimeIndex(np.load(os.path.join(path, '{}_index.npy'.format(chunk))))
+        first = 0 if start is None else chunk_index.searchsorted(pd.Timestamp(start))
+        last = len(chunk_index) if end is None else chunk_index.searchsorted(pd.Timestamp(end))
+
+        if first < last:
+            chunk_values = np.load(os.path.join(path, '{}.npy'.format(chunk)), mmap_mode='r')
+            values.append(np.array(chunk_values[first:last]))
+            index.append(chunk_index[first:last])
+            columns = pd.read_pickle(os.path.join(path, '{}_columns'.format(chunk)))
+
+    if not values:
+        raise KeyError('No chunks of {} between {} and {}'.format(stage, start, end))
+
+    return pd.DataFrame(np.concatenate(values), index=index[0].append(index[1:]), columns=columns)
+
+
+def chunks(store_path, stage):
+
+    # Chunks are named by their position in time, e.g. the year
+    path = os.path.join(store_path, stage)
+
+    return sorted(int(file[:-4]) for file in os.listdir(path) if file.endswith('.npy') and '_' not in file)
+
+
+def clear(store_path):
+
+    # Chunks from previous runs are removed
+    if os.path.isdir(store_path):
+        shutil.rmtree(store_path)
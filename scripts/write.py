@@ -1,7 +1,16 @@
 
 import os
+import json
+import shutil
 import sqlite3
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from itertools import groupby
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from scripts.metadata import get_field
 
 
 def shaping(demand, cop):
@@ -10,62 +19,205 @@ def shaping(demand, cop):
     df = pd.concat([demand, cop], axis=1)
     df = df.sort_index(level=0, axis=1)
 
-    # Timestamp
-    index = pd.DatetimeIndex(df.index)
-    df.index = pd.MultiIndex.from_tuples(zip(
-        index.strftime('%Y-%m-%dT%H:%M:%SZ'),
-        index.tz_convert('Europe/Brussels').strftime('%Y-%m-%dT%H:%M:%S%z')
-    ))
-    df.index.names = ['utc_timestamp', 'cet_cest_timestamp']
-
-    # SingleIndex
-    single = df.copy()
-    single.columns = ['_'.join([level for level in col_name[0:3]]) for col_name in df.columns.values]
-    single.insert(0, 'cet_cest_timestamp', single.index.get_level_values(1))
-    single.index = single.index.droplevel(['cet_cest_timestamp'])
-
-    # Stacked
-    stacked = df.copy()
-    stacked.index = stacked.index.droplevel(['cet_cest_timestamp'])
-    stacked.columns = stacked.columns.droplevel(['unit'])
-    stacked = stacked.transpose().stack(dropna=True).to_frame(name='data')
-
-    # Excel
-    df_excel = df.copy()
-    df_excel.index = pd.MultiIndex.from_tuples(zip(
-        index.strftime('%Y-%m-%dT%H:%M:%SZ'),
-        index.tz_convert('Europe/Brussels').strftime('%Y-%m-%dT%H:%M:%S')
-    ))
-
+    # The shapes differ only in their headers and timestamp columns, which are formatted once and shared,
+    # and are written from the same values by the writers
     return {
         'multiindex': df,
-        'singleindex': single,
-        'stacked': stacked,
-        'excel': df_excel
+        'timestamps': timestamps(pd.DatetimeIndex(df.index))
     }
 
 
-def to_sql(shaped_dfs, output_path, home_path):
+def timestamps(index):
+
+    utc = index.tz_convert('UTC').tz_localize(None).values
+    local = index.tz_convert('Europe/Brussels').tz_localize(None).values
+
+    # UTC offsets of the local time as in %z, formatted once per distinct offset
+    offsets, positions = np.unique((local - utc) // np.timedelta64(1, 'm'), return_inverse=True)
+    offsets = np.array(['{}{:02d}{:02d}'.format('-' if offset < 0 else '+', *divmod(abs(offset), 60))
+                        for offset in offsets.tolist()])
+
+    local = np.datetime_as_string(local, unit='s')
+    return {
+        'utc_timestamp': np.char.add(np.datetime_as_string(utc, unit='s'), 'Z'),
+        'cet_cest_timestamp': np.char.add(local, offsets[positions]),
+        'excel': local
+    }
+
+
+def singleindex_columns(df):
+
+    return ['_'.join([level for level in col_name[0:3]]) for col_name in df.columns.values]
+
+
+def header(shape, df, sep):
+
+    # Header lines as written by pandas, from an empty frame of the shape
+    if shape == 'singleindex':
+        empty = pd.DataFrame(columns=['cet_cest_timestamp'] + singleindex_columns(df),
+                             index=pd.Index([], name='utc_timestamp'))
+    else:
+        empty = pd.DataFrame(columns=df.columns, index=pd.MultiIndex.from_arrays([[], []]))
+        if shape == 'multiindex':
+            empty.index.names = ['utc_timestamp', 'cet_cest_timestamp']
+
+    return empty.to_csv(sep=sep)
+
+
+def to_sql(shaped_dfs, output_path, home_path, chunk_size=8760, stacked_table=False):
+
+    df = shaped_dfs['multiindex']
+    timestamps = shaped_dfs['timestamps']
+    columns = singleindex_columns(df)
 
     os.chdir(output_path)
     table = 'when2heat'
-    shaped_dfs['singleindex'].to_sql(table, sqlite3.connect('when2heat.sqlite'),
-                                     if_exists='replace', index_label='utc_timestamp')
+    connection = sqlite3.connect('when2heat.sqlite')
+    for start in range(0, max(len(df), 1), chunk_size):
+        rows = slice(start, start + chunk_size)
+        chunk = pd.DataFrame(df.values[rows], index=pd.Index(timestamps['utc_timestamp'][rows]), columns=columns)
+        chunk.insert(0, 'cet_cest_timestamp', timestamps['cet_cest_timestamp'][rows])
+        chunk.to_sql(table, connection, if_exists='replace' if start == 0 else 'append',
+                     index_label='utc_timestamp')
+
+    # Optionally, the stacked shape is inserted record by record from the stream of its blocks
+    if stacked_table:
+        with connection:
+            connection.execute('DROP TABLE IF EXISTS {}_stacked'.format(table))
+            connection.execute('CREATE TABLE {}_stacked (utc_timestamp TEXT, country TEXT, variable TEXT, '
+                               'attribute TEXT, data REAL)'.format(table))
+            connection.executemany('INSERT INTO {}_stacked VALUES (?, ?, ?, ?, ?)'.format(table),
+                                   stacked_records(shaped_dfs, chunk_size))
+    connection.close()
     os.chdir(home_path)
 
 
-def to_csv(shaped_dfs, output_path):
+def to_csv(shaped_dfs, output_path, chunk_size=1000, workers=1):
 
-    for shape, df in shaped_dfs.items():
+    df = shaped_dfs['multiindex']
+    timestamps = shaped_dfs['timestamps']
+
+    for shape in ['singleindex', 'multiindex', 'excel']:
 
         if shape == 'excel':
             file = os.path.join(output_path, 'when2heat.xlsx.csv')
-            df.to_csv(file, sep=';', decimal=',', float_format='%g')
+            columns = [timestamps['utc_timestamp'], timestamps['excel']]
+            sep, decimal = ';', ','
 
         elif shape == 'singleindex':
             file = os.path.join(output_path, 'when2heat.csv')
-            df.to_csv(file, sep=';', decimal=',', float_format='%g')
+            columns = [timestamps['utc_timestamp'], timestamps['cet_cest_timestamp']]
+            sep, decimal = ';', ','
 
         else:
             file = os.path.join(output_path, 'when2heat_{}.csv'.format(shape))
-            df.to_csv(file, float_format='%g')
+            columns = [timestamps['utc_timestamp'], timestamps['cet_cest_timestamp']]
+            sep, decimal = ',', '.'
+
+        write_csv(file, header(shape, df, sep), columns, df.values, sep, decimal, chunk_size, workers)
+
+    # Stacked, streamed from the blocks of each column instead of a stacked frame
+    with open(os.path.join(output_path, 'when2heat_stacked.csv'), 'w') as f:
+        f.write('country,variable,attribute,utc_timestamp,data\n')
+        for labels, utc_timestamps, values in stacked(shaped_dfs, chunk_size):
+            f.write(csv_rows([utc_timestamps], values[:, np.newaxis], ',', '.', prefix=','.join(labels) + ','))
+
+
+def stacked(shaped_dfs, block_size=8760):
+
+    # Blocks of the long shape as the country, variable and attribute of a column
+    # with the UTC timestamps and values of up to block_size of its non-missing rows
+    df = shaped_dfs['multiindex']
+    utc_timestamps = shaped_dfs['timestamps']['utc_timestamp']
+    data = df.values
+
+    for position, (country, variable, attribute, _) in enumerate(df.columns):
+        values = data[:, position]
+        rows = np.flatnonzero(~np.isnan(values))
+        for start in range(0, len(rows), block_size):
+            block = rows[start:start + block_size]
+            yield (country, variable, attribute), utc_timestamps[block], values[block]
+
+
+def stacked_records(shaped_dfs, block_size=8760):
+
+    # Records (utc_timestamp, country, variable, attribute, data) of the long shape
+    for labels, utc_timestamps, values in stacked(shaped_dfs, block_size):
+        for utc_timestamp, value in zip(utc_timestamps.tolist(), values.tolist()):
+            yield (utc_timestamp, *labels, value)
+
+
+def to_parquet(shaped_dfs, output_path):
+
+    df = shaped_dfs['multiindex']
+    utc_timestamps = pd.DatetimeIndex(df.index).asi8
+    data = df.values
+
+    root = os.path.join(output_path, 'when2heat.parquet')
+    shutil.rmtree(root, ignore_errors=True)
+
+    # The long shape is partitioned by country and variable into directories as read by pyarrow datasets,
+    # with one row group per attribute of float32 data and dictionary-encoded attributes and units
+    for (country, variable), columns in groupby(enumerate(df.columns), key=lambda column: column[1][:2]):
+        positions, columns = zip(*columns)
+        attributes = [attribute for _, _, attribute, _ in columns]
+        units, unit_positions = np.unique([unit for _, _, _, unit in columns], return_inverse=True)
+
+        labels = np.repeat(np.arange(len(columns), dtype='int16'), len(df))
+        arrays = [
+            pa.array(np.tile(utc_timestamps, len(columns)), type=pa.timestamp('ns', tz='UTC')),
+            pa.DictionaryArray.from_arrays(pa.array(labels), pa.array(attributes)),
+            pa.DictionaryArray.from_arrays(pa.array(unit_positions.astype('int16')[labels]), pa.array(units)),
+            pa.array(data[:, list(positions)].astype('float32').T.ravel(), from_pandas=True)
+        ]
+
+        # The field metadata of the datapackage are kept with each partition
+        schema = pa.schema(
+            [pa.field(name, array.type) for name, array in zip(['utc_timestamp', 'attribute', 'unit', 'data'], arrays)],
+            metadata={'fields': json.dumps([get_field(column) for column in columns])}
+        )
+
+        partition = os.path.join(root, 'country={}'.format(country), 'variable={}'.format(variable))
+        os.makedirs(partition)
+        pq.write_table(pa.Table.from_arrays(arrays, schema=schema), os.path.join(partition, 'part-0.parquet'),
+                       row_group_size=max(len(df), 1), compression='zstd', use_dictionary=['attribute', 'unit'],
+                       column_encoding={'utc_timestamp': 'DELTA_BINARY_PACKED', 'data': 'BYTE_STREAM_SPLIT'})
+
+
+def write_csv(file, header, columns, values, sep=',', decimal='.', chunk_size=1000, workers=1):
+
+    # Rows are formatted in chunks, optionally in parallel, and written in order as they are completed
+    chunks = ((
+        [column[start:start + chunk_size] for column in columns], values[start:start + chunk_size], sep, decimal
+    ) for start in range(0, len(values), chunk_size))
+
+    with open(file, 'w') as f:
+        f.write(header)
+
+        if workers == 1:
+            for chunk in chunks:
+                f.write(csv_rows(*chunk))
+
+        else:
+            # At most two chunks per worker are pending at a time
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                pending = deque()
+                for chunk in chunks:
+                    pending.append(executor.submit(csv_rows, *chunk))
+                    if len(pending) >= 2 * workers:
+                        f.write(pending.popleft().result())
+                while pending:
+                    f.write(pending.popleft().result())
+
+
+def csv_rows(columns, values, sep, decimal, prefix=''):
+
+    # Values as formatted by pandas with float_format='%g' and missing values as empty fields
+    row_format = sep.join(['%g'] * values.shape[1])
+    cells = '\n'.join([row_format % tuple(row) for row in values.tolist()])
+    cells = cells.replace('nan', '')
+    if decimal != '.':
+        cells = cells.replace('.', decimal)
+
+    return ''.join([prefix + sep.join(labels) + sep + row + '\n'
+                    for *labels, row in zip(*[column.tolist() for column in columns], cells.split('\n'))])
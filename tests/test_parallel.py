@@ -0,0 +1,45 @@
+
+import numpy as np
+import pandas as pd
+import scripts.cop as cop
+
+
+def synthetic_frames(countries=('AT', 'DE', 'FR'), cells=60, year=2008):
+
+    # Random COP and spatial demand for a regular grid of cells per country, with enough cells
+    # for the sums over the cells to depend on the order in which they are added
+    random = np.random.RandomState(0)
+    grid = [(45 + .75 * i, 5 + .75 * j) for i in range(cells // 6) for j in range(6)]
+    local = pd.date_range('{}-01-01'.format(year), '{}-12-31 23:00'.format(year), freq='H', name='time')
+    utc = pd.date_range('{}-12-31 23:00'.format(year - 1), '{}-12-31 22:00'.format(year), freq='H', tz='utc')
+
+    columns = pd.MultiIndex.from_tuples(
+        [(country, sink, source) + cell for country in countries for sink in ['floor', 'radiator', 'water']
+         for source in ['air', 'ground', 'water'] for cell in grid],
+        names=['country', 'sink', 'source', 'latitude', 'longitude']
+    )
+    spatial_cop = pd.DataFrame(random.uniform(2, 6, (len(local), len(columns))).astype('float32'),
+                               index=local, columns=columns)
+
+    def spatial():
+        columns = pd.MultiIndex.from_tuples(
+            [(country, building_type) + cell for country in countries for building_type in ['SFH', 'MFH', 'COM']
+             for cell in grid],
+            names=['country', 'building_type', 'latitude', 'longitude']
+        )
+        weighted = pd.DataFrame(random.gamma(2, 1, (len(utc), len(columns))).astype('float32'),
+                                index=utc, columns=columns)
+        keys = columns.droplevel(['latitude', 'longitude']).unique()
+        return {'weighted': weighted, 'normalized': pd.Series(random.uniform(50, 500, len(keys)), index=keys)}
+
+    return spatial_cop, spatial(), spatial()
+
+
+def test_cop_aggregation_independent_of_workers():
+
+    spatial_cop, spatial_space, spatial_water = synthetic_frames()
+
+    serial = cop.aggregation(spatial_cop, spatial_space, spatial_water, workers=1)
+    parallel = cop.aggregation(spatial_cop, spatial_space, spatial_water, workers=2)
+
+    pd.testing.assert_frame_equal(serial, parallel, check_exact=True)